@@ -72,6 +72,10 @@ class Application:
             self.__downloader.download_file
         )
 
+        self.__file_browser.set_folder_downloader(
+            self.__downloader.download_folder
+        )
+
         self.__filesframe = self.__file_browser.get_container()
 
         self.__panes.insert('end', self.__filesframe)
@@ -148,7 +152,9 @@ class Application:
         self.__tk.mainloop()
 
     def __get_client_for(self, addr):
-        self.__client = PyFSClient(addr, 'progress.shelf')
+        self.__client = PyFSClient(
+            addr, 'progress.journal', self.__downloader.client_event
+        )
         self.__downloader.set_client(self.__client)
         return self.__client
 
@@ -1,7 +1,7 @@
 import math
-import time
-import statistics
+import queue
 import pathlib
+import traceback
 
 import tkinter as tk
 from tkinter import ttk
@@ -11,12 +11,22 @@ import format_size
 
 import preferences
 
+# Milliseconds between reads of the progress of running downloads
+progress_refresh_interval = 250
+
+# Events from the client are shown in batches at this interval in
+# milliseconds, at most this many at a time
+events_drain_interval = 50
+events_drain_batch = 2000
+
 class Downloader:
     def __init__(self):
         self.__client = None
         self.__tasklist = None
 
-        self.__dl_updates = []
+        # Events arrive on the client's threads and are shown by the Tk loop
+        self.__dl_events = queue.Queue()
+        self.__dl_connected = False
         self.__dl_tasks = {}
         self.__tasklist_current_selection = None
 
@@ -119,24 +129,41 @@ class Downloader:
 
         self.__tasklist.bind('<<TreeviewSelect>>', self.__tasklist_select)
 
+        self.__tasklist_menu = tk.Menu(self.__tasklist, tearoff=False)
+
+        self.__tasklist_menu.add(
+            tk.COMMAND, label='Move to front',
+            command=self.__tasklist_front_click
+        )
+
+        self.__tasklist.bind('<ButtonPress-3>', self.__tasklist_menu_show)
+
         self.__single_task_buttons_update()
         self.__all_tasks_buttons_update()
 
         self.__prefs = preferences.get_instance()
 
+        self.__tasksframe.after(
+            progress_refresh_interval, self.__refresh_progress
+        )
+
+        self.__tasksframe.after(events_drain_interval, self.__drain_events)
+
     def get_container(self): return self.__tasksframe
 
+    # Events are held until the file browser has connected. The client is
+    # made with client_event as its callback so none are missed.
     def set_client(self, client):
         self.__client = client
-        self.__client.getfile_monitor_silence(self.__download_progress_pre)
+        self.__dl_connected = False
+
+    def client_event(self, event): self.__dl_events.put(event)
 
-    def notify_file_browser_connected(self):
-        self.__client.getfile_monitor_silence(self.__download_progress)
-        self.__render_silenced_updates()
+    def notify_file_browser_connected(self): self.__dl_connected = True
 
     def clear_tasks_list(self):
         self.__tasklist_current_selection = None
-        self.__dl_tasks = []
+        self.__dl_tasks = {}
 
         for child in self.__tasklist.get_children():
             self.__tasklist.delete(child)
@@ -155,6 +182,11 @@ class Downloader:
             tkutils.disable_widget(self.__tasklist_resumeone_button)
             tkutils.disable_widget(self.__tasklist_cancelone_button)
 
+        elif task['folder']: # Folders can only be cancelled
+            tkutils.disable_widget(self.__tasklist_pauseone_button)
+            tkutils.disable_widget(self.__tasklist_resumeone_button)
+            tkutils.enable_widget(self.__tasklist_cancelone_button)
+
         elif task['paused']:
             tkutils.disable_widget(self.__tasklist_pauseone_button)
             tkutils.enable_widget(self.__tasklist_resumeone_button)
@@ -170,6 +202,7 @@ class Downloader:
 
         for task in self.__dl_tasks:
             if self.__dl_tasks[task]['done']: done = True
+            elif self.__dl_tasks[task]['folder']: continue
             elif self.__dl_tasks[task]['paused']: paused = True
             else: resumed = True
 
@@ -219,6 +252,23 @@ class Downloader:
             if not self.__dl_tasks[sel]['done']:
                 self.__client.getfile_cancel(sel)
 
+    def __tasklist_menu_show(self, event):
+        row = self.__tasklist.identify_row(event.y)
+        if row == '' or row not in self.__dl_tasks: return
+
+        task = self.__dl_tasks[row]
+        if task['done'] or task['folder']: return
+
+        self.__tasklist.selection_set(row)
+        self.__tasklist_menu.tk_popup(event.x_root, event.y_root)
+
+    def __tasklist_front_click(self):
+        sel = self.__tasklist_current_selection
+
+        if sel != None and sel in self.__dl_tasks:
+            if not self.__dl_tasks[sel]['done']:
+                self.__client.getfile_front(sel)
+
     def __tasklist_clearcomplete_click(self):
         remaining = {}
 
@@ -229,8 +279,9 @@ class Downloader:
         self.__dl_tasks = remaining
         self.__all_tasks_buttons_update()
 
+    # Files already downloaded are updated with just the parts that changed
     def download_file(self, path, name):
-        params = {}
+        params = {'update': True}
 
         dest = self.__prefs.get_download_dest()
 
@@ -243,6 +294,16 @@ class Downloader:
 
         self.__client.getfile(path, **params)
 
+    def download_folder(self, path, name):
+        dest = self.__prefs.get_download_dest()
+        saveto = '.'
+
+        if dest != None:
+            d = pathlib.Path(dest).resolve()
+            if d.exists() and d.is_dir(): saveto = str(d)
+
+        self.__client.getfolder(path, saveto)
+
     def __update_task(self, key, name, values=None, image=None):
         params = {}
 
@@ -254,14 +315,19 @@ class Downloader:
 
         else: self.__tasklist.insert('', 'end', iid=key, text=name, **params)
 
-    def __download_progress_pre(self, data): self.__dl_updates.append(data)
-
     def __download_progress_percent(self, data):
-        numerator = data['partdone'] + 1
-        denominator = data['partmax'] + 1
-        percent = math.floor(100 * numerator/ denominator)
+        if data['size'] == 0: return '100%'
+
+        percent = math.floor(100 * data['bytesdone'] / data['size'])
         return str(percent) + '%'
 
+    def __download_progress_eta(self, eta):
+        minutes, seconds = divmod(round(eta), 60)
+        hours, minutes = divmod(minutes, 60)
+
+        if hours > 0: return '%d:%02d:%02d left' % (hours, minutes, seconds)
+        else: return '%d:%02d left' % (minutes, seconds)
+
     def __download_progress(self, data):
         if 'status' not in data: return
 
@@ -272,18 +338,24 @@ class Downloader:
 
         if path in self.__dl_tasks: tname = self.__dl_tasks[path]['name']
 
-        elif 'name' in data:
+        # Downloads that failed to start are not named
+        else:
+            if 'name' in data: tname = data['name']
+            else: tname = pathlib.PurePosixPath(path).name or path
+
             self.__dl_tasks[path] = {
-                'name': data['name'], 'lastupdated': time.monotonic(),
-                'timestaken': [], 'done': False, 'paused': False
+                'name': tname, 'done': False, 'paused': False,
+                'verifying': False, 'shown': None,
+                'folder': 'folder' in data and data['folder']
             }
 
-            tname = data['name']
-
-        else: tname = path
-
+        # A finished download of the same file may be started again
         if status == 'filestarted':
-            self.__update_task(path, tname, ('Started'))
+            self.__update_task(path, tname, ('Started'), '')
+            self.__dl_tasks[path].update({
+                'done': False, 'paused': False, 'verifying': False,
+                'shown': None
+            })
 
         elif status == 'fileerror':
             self.__update_task(path, tname, ('Failed', self.__icon_broken))
@@ -295,44 +367,116 @@ class Downloader:
 
         elif status == 'filepaused':
             percent = self.__download_progress_percent(data)
-            self.__update_task(path, tname, (percent, 'Paused'))
+            if data.get('unverified'): state = 'Paused, not verified'
+            else: state = 'Paused'
+
+            self.__update_task(path, tname, (percent, state))
             self.__dl_tasks[path]['paused'] = True
+            self.__dl_tasks[path]['verifying'] = False
 
         elif status == 'fileresumed':
             percent = self.__download_progress_percent(data)
-            self.__update_task(path, tname, (percent, 'Resumed'))
+            if data.get('unverified'): state = 'Resumed, not verified'
+            else: state = 'Resumed'
+
+            self.__update_task(path, tname, (percent, state))
             self.__dl_tasks[path]['paused'] = False
+            self.__dl_tasks[path]['verifying'] = False
 
-        elif status == 'fileprogress':
-            self.__dl_tasks[path]['timestaken'].append(data['timetaken'])
+        elif status == 'fileverifying':
+            percent = self.__download_progress_percent(data)
+            self.__update_task(path, tname, (percent, 'Verifying'))
+            self.__dl_tasks[path]['verifying'] = True
 
-            if time.monotonic() - self.__dl_tasks[path]['lastupdated'] < 0.1:
-                return
+        # Only for downloads whose progress the client cannot share
+        elif status == 'fileprogress':
+            self.__show_progress(path, tname, data)
 
-            timetakenavg = statistics.mean(self.__dl_tasks[path]['timestaken'])
-            rate = data['partsize'] / timetakenavg
+        elif status == 'folderprogress':
+            rate = data['partsize'] / data['timetaken']
             rate = format_size.shortensize(rate) +'/s'
-            percent = self.__download_progress_percent(data)
+            size = format_size.shortensize(data['bytesdone'])
 
-            self.__update_task(path, tname, (percent, rate))
-            self.__dl_tasks[path]['lastupdated'] = time.monotonic()
-            self.__dl_tasks[path]['timestaken'] = []
+            if 'files' in data:
+                files = '%d/%d files' % (data['filesdone'], data['files'])
+                size = files + ', ' + size
+
+            self.__update_task(path, tname, (size, rate))
 
         elif status == 'filecanceled':
             self.__update_task(path, tname, ('Cancelled'))
             self.__dl_tasks[path]['done'] = True
 
-        if self.__tasklist_current_selection == path:
-            self.__single_task_buttons_update(path)
+    def __show_progress(self, path, tname, data):
+        rate = format_size.shortensize(data['avgrate']) +'/s'
 
-        self.__all_tasks_buttons_update()
+        if data['eta'] != None:
+            rate += ', ' + self.__download_progress_eta(data['eta'])
 
-    def __render_silenced_updates(self):
-        if len(self.__dl_updates) > 0:
-            for update in self.__dl_updates:
-                self.__download_progress(update)
-            self.__dl_updates = []
+        percent = self.__download_progress_percent(data)
+        self.__update_task(path, tname, (percent, rate))
 
-        else:
-            self.__single_task_buttons_update()
-            self.__all_tasks_buttons_update()
+    # Progress of running downloads is read from the client on a timer rather
+    # than sent as events. Rows are only touched when it has changed.
+    def __refresh_progress(self):
+        try:
+            for path, task in list(self.__dl_tasks.items()):
+                if self.__client == None: break
+
+                if task['done'] or task['paused'] or task['folder']: continue
+                if task['verifying']: continue
+
+                progress = self.__client.getfile_progress(path)
+                if progress == None: continue
+
+                shown = (progress['bytesdone'], progress['avgrate'])
+                if shown == task['shown']: continue
+
+                task['shown'] = shown
+                self.__show_progress(path, task['name'], progress)
+
+        finally:
+            self.__tasksframe.after(
+                progress_refresh_interval, self.__refresh_progress
+            )
+
+    # Of the progress events of a download only the latest is shown, unless
+    # another event of the download came in between. The buttons are updated
+    # once for the whole batch. An event that cannot be shown does not stop
+    # the rest.
+    def __drain_events(self):
+        batch = []
+        latest = {} # Downloads' latest progress as path: index in batch
+
+        while self.__dl_connected and len(batch) < events_drain_batch:
+            try: data = self.__dl_events.get_nowait()
+            except queue.Empty: break
+
+            path = data.get('path')
+            status = data.get('status')
+
+            if status in ('fileprogress', 'folderprogress'):
+                if path in latest:
+                    batch[latest[path]] = data
+                    continue
+
+                latest[path] = len(batch)
+
+            else: latest.pop(path, None)
+
+            batch.append(data)
+
+        if len(batch) < events_drain_batch: wait = events_drain_interval
+        else: wait = 1
+
+        try:
+            for data in batch:
+                try: self.__download_progress(data)
+                except Exception: traceback.print_exc()
+
+            if len(batch) > 0:
+                selection = self.__tasklist_current_selection
+                self.__single_task_buttons_update(selection)
+                self.__all_tasks_buttons_update()
+
+        finally: self.__tasksframe.after(wait, self.__drain_events)
@@ -7,17 +7,26 @@ from tkinter import ttk
 import tkutils
 import format_size
 
+# Entries fetched from servers that list directories in pages, at a time
+list_page_rows = 500
+
+# Rows kept in the file list above and below the visible ones, so that
+# scrolling a little needs no new rows
+list_view_margin = 50
+
 class FileBrowser:
     def __init__(self):
         self.__client = None
-        self.__listings = []
+        self.__listings = [] # Directories shown, the current one last
         self.__listings_forward = []
+        self.__filelist_window = (0, 0) # Entries with rows as (first, end)
         self.__server_addr = ''
 
         self.__title_listener = None
         self.__client_provider = None
         self.__connect_success_listener = None
         self.__file_downloader = None
+        self.__folder_downloader = None
 
         self.__icon_go = tkutils.load_icon('icons/go.png')
         self.__icon_disconnect = tkutils.load_icon('icons/disconnect.png')
@@ -93,13 +102,23 @@ class FileBrowser:
             row=1, column=5, sticky=tk.NS, pady=(8, 0), padx=(8, 0)
         )
 
-        self.__filelist_scrollbar['command'] = self.__filelist.yview
-        self.__filelist['yscrollcommand'] = self.__filelist_scrollbar.set
+        # The scrollbar spans the whole directory, not just the rows present
+        self.__filelist_scrollbar['command'] = self.__scrollbar_moved
+        self.__filelist['yscrollcommand'] = self.__filelist_scrolled
 
         self.__filesframe.grid_rowconfigure(1, weight=1)
         self.__filesframe.grid_columnconfigure(3, weight=1)
 
         self.__filelist.bind('<Double-ButtonPress-1>', self.__filelist_select)
+        self.__filelist.bind('<Configure>', self.__filelist_resized)
+
+        self.__filelist_menu = tk.Menu(self.__filelist, tearoff=False)
+
+        self.__filelist_menu.add(
+            tk.COMMAND, label='Download', command=self.__filelist_download
+        )
+
+        self.__filelist.bind('<ButtonPress-3>', self.__filelist_menu_show)
 
     def get_container(self): return self.__filesframe
 
@@ -108,7 +127,7 @@ class FileBrowser:
             self.__client = self.__get_client_for(addr)
 
         if self.__client != None:
-            listing = self.__client.list()
+            listing = self.__load_listing('')
 
             if listing == None:
                 if not self.__client.server_ok(): self.__client = None
@@ -137,6 +156,8 @@ class FileBrowser:
         for child in self.__filelist.get_children():
             self.__filelist.delete(child)
 
+        self.__filelist_window = (0, 0)
+
         if len(self.__listings_forward) > 0:
             tkutils.enable_widget(self.__filelist_forward_button)
 
@@ -144,35 +165,137 @@ class FileBrowser:
 
         if len(self.__listings) == 0:
             tkutils.disable_widget(self.__filelist_refresh_button)
+            self.__filelist_scrollbar.set(0, 1)
             self.__set_title()
             return
 
         tkutils.enable_widget(self.__filelist_refresh_button)
 
         listing = self.__listings[-1]
-        self.__set_title(self.__server_addr + listing['info']['path'])
-
-        if 'dirs' in listing['info']:
-            for dir in listing['info']['dirs']:
-                self.__filelist.insert(
-                    '', 'end', iid=dir, text=dir, image=self.__icon_folder
-                )
-
-        if 'files' in listing['info']:
-            if 'fileinfo' in listing['info']:
-                for file in listing['info']['files']:
-                    if file in listing['info']['fileinfo']:
-                        size = listing['info']['fileinfo'][file]['size']
-                        created = listing['info']['fileinfo'][file]['created']
-                        mod = listing['info']['fileinfo'][file]['modified']
-                        values = (size, created, mod)
-
-                    else: values = ('', '', '')
-
-                    self.__filelist.insert(
-                        '', 'end', iid=file, text=file, values=values,
-                        image=self.__icon_file
-                    )
+        self.__set_title(self.__server_addr + listing['path'])
+        self.__render_rows(listing['first'])
+
+    # Only the rows in view and a margin around them are in the file list.
+    # They are named by their index in the directory.
+    def __render_rows(self, first):
+        listing = self.__listings[-1]
+        total = listing['total']
+        visible = self.__visible_rows()
+
+        first = max(min(first, total - visible), 0)
+        start = max(first - list_view_margin, 0)
+        end = min(first + visible + list_view_margin, total)
+
+        shown_start, shown_end = self.__filelist_window
+
+        if end <= shown_start or start >= shown_end:
+            for child in self.__filelist.get_children():
+                self.__filelist.delete(child)
+
+            shown_start, shown_end = start, start
+
+        for index in range(shown_start, min(start, shown_end)):
+            self.__filelist.delete(str(index))
+
+        for index in range(max(end, shown_start), shown_end):
+            self.__filelist.delete(str(index))
+
+        shown_start, shown_end = max(shown_start, start), min(shown_end, end)
+
+        for index in range(shown_start - 1, start - 1, -1):
+            self.__insert_row(listing, index, 0)
+
+        for index in range(shown_end, end): self.__insert_row(listing, index)
+
+        self.__filelist_window = (start, end)
+        listing['first'] = first
+
+        if end > start:
+            self.__filelist.yview_moveto((first - start) / (end - start))
+
+        self.__scrollbar_update()
+
+    def __rerender_rows(self):
+        if len(self.__listings) > 0:
+            self.__render_rows(self.__listings[-1]['first'])
+
+    def __insert_row(self, listing, index, position='end'):
+        entry = self.__listing_entry(listing, index)
+
+        if entry == None: # Gone from the directory since it was listed
+            self.__filelist.insert('', position, iid=str(index), text='')
+
+        elif entry['dir']:
+            self.__filelist.insert(
+                '', position, iid=str(index), text=entry['name'],
+                image=self.__icon_folder
+            )
+
+        else:
+            self.__filelist.insert(
+                '', position, iid=str(index), text=entry['name'],
+                values=entry['values'], image=self.__icon_file
+            )
+
+    def __visible_rows(self):
+        rowheight = ttk.Style().lookup('Treeview', 'rowheight')
+
+        try: rowheight = int(rowheight)
+        except ValueError: rowheight = 20
+
+        # Less one for the headings
+        return max(self.__filelist.winfo_height() // rowheight - 1, 1)
+
+    def __scrollbar_update(self):
+        listing = self.__listings[-1]
+        total = listing['total']
+
+        if total == 0:
+            self.__filelist_scrollbar.set(0, 1)
+            return
+
+        last = min(listing['first'] + self.__visible_rows(), total)
+        self.__filelist_scrollbar.set(listing['first'] / total, last / total)
+
+    # The file list scrolls by itself within its rows. New rows are made once
+    # it comes close to either end of them.
+    def __filelist_scrolled(self, top, bottom):
+        start, end = self.__filelist_window
+
+        if len(self.__listings) == 0 or end <= start:
+            self.__filelist_scrollbar.set(top, bottom)
+            return
+
+        listing = self.__listings[-1]
+        first = start + round(float(top) * (end - start))
+        listing['first'] = first
+        self.__scrollbar_update()
+
+        last = first + self.__visible_rows()
+        near_start = start > 0 and first - start < list_view_margin // 2
+        near_end = end < listing['total'] and end - last < list_view_margin // 2
+
+        if near_start or near_end:
+            self.__filelist.after_idle(self.__rerender_rows)
+
+    def __scrollbar_moved(self, *args):
+        if len(self.__listings) == 0: return
+
+        listing = self.__listings[-1]
+
+        if args[0] == 'moveto':
+            first = round(float(args[1]) * listing['total'])
+
+        elif args[0] == 'scroll':
+            rows = int(args[1])
+            if args[2] == 'pages': rows *= self.__visible_rows()
+            first = listing['first'] + rows
+
+        else: return
+
+        self.__render_rows(first)
+
+    def __filelist_resized(self, event): self.__rerender_rows()
 
     def __filelist_go(self):
         address = self.__address_bar_value.get()
@@ -208,65 +331,140 @@ class FileBrowser:
     def __filelist_refresh(self):
         if len(self.__listings) == 0: return
 
-        path = self.__listings[-1]['info']['path']
-        listing = self.__client.list(path)
+        # Stays scrolled to where it was
+        first = self.__listings[-1]['first']
+        listing = self.__load_listing(self.__listings[-1]['path'])
 
-        if listing != None and listing['status'] == 'ok':
-            self.__listing_fetch_details(listing)
+        if listing != None:
+            listing['first'] = first
             self.__listings.pop()
             self.__listings.append(listing)
             self.__display_listing()
 
-    def __listing_fetch_details(self, listing):
-        if 'files' in listing['info']:
-            listing['info']['fileinfo'] = {}
+    # Directories are fetched a page at a time as they are scrolled through
+    # from servers that list them in pages, and whole from others. Listings
+    # hold the pages fetched so far.
+    def __load_listing(self, path):
+        response = self.__client.list_page(path, 0, list_page_rows)
 
-            for file in listing['info']['files']:
-                path = listing['info']['path'] + file
-                fileinfo = self.__client.list(path)
-                infmt = '%j%Y%H%M%S%z'
-                outfmt = '%a %d %b %Y, %I:%M:%S %p'
+        if response == None or response.get('status') != 'ok': return None
+        if response.get('type') != 'dir': return None
 
-                if fileinfo != None and fileinfo['status'] == 'ok':
-                    parsedinfo = {}
-                    size = fileinfo['info']['size']
-                    parsedinfo['size'] = format_size.shortensize(size)
+        info = response['info']
+        listing = {'path': info['path'], 'first': 0, 'pages': {}}
 
-                    moment = fileinfo['info']['created']
-                    moment = time.strptime(moment, infmt)
-                    moment = time.strftime(outfmt, moment)
-                    parsedinfo['created'] = moment
+        if 'total' in info:
+            listing['total'] = info['total']
+            listing['pagesize'] = list_page_rows
 
-                    moment = fileinfo['info']['modified']
-                    moment = time.strptime(moment, infmt)
-                    moment = time.strftime(outfmt, moment)
-                    parsedinfo['modified'] = moment
+        else:
+            listing['total'] = len(info.get('dirs', []))
+            listing['total'] += len(info.get('files', []))
+            listing['pagesize'] = max(listing['total'], 1)
 
-                    listing['info']['fileinfo'][file] = parsedinfo
+        listing['pages'][0] = self.__page_entries(info)
+        return listing
 
-    def __filelist_select(self, event):
+    # Returns the entry at index of a listing or None if there is none there
+    def __listing_entry(self, listing, index):
+        page, row = divmod(index, listing['pagesize'])
+
+        if page not in listing['pages']:
+            size = listing['pagesize']
+            path = listing['path']
+            response = self.__client.list_page(path, page * size, size)
+            entries = []
+
+            if response != None and response.get('status') == 'ok':
+                info = response['info']
+                entries = self.__page_entries(info)
+                listing['total'] = info.get('total', listing['total'])
+
+            listing['pages'][page] = entries
+
+        entries = listing['pages'][page]
+        if row < len(entries): return entries[row]
+
+    def __page_entries(self, info):
+        entries = []
+
+        for dir in info.get('dirs', []):
+            entries.append({'name': dir, 'dir': True})
+
+        if 'fileinfo' in info: fileinfo = info['fileinfo']
+
+        else: # Servers that do not send file details with the listing
+            fileinfo = {}
+
+            for file in info.get('files', []):
+                details = self.__client.list(info['path'] + file)
+
+                if details != None and details['status'] == 'ok':
+                    fileinfo[file] = details['info']
+
+        for file in info.get('files', []):
+            if file in fileinfo: values = self.__file_values(fileinfo[file])
+            else: values = ('', '', '')
+
+            entries.append({'name': file, 'dir': False, 'values': values})
+
+        return entries
+
+    def __file_values(self, fileinfo):
+        infmt = '%j%Y%H%M%S%z'
+        outfmt = '%a %d %b %Y, %I:%M:%S %p'
+
+        size = format_size.shortensize(fileinfo['size'])
+
+        moment = time.strptime(fileinfo['created'], infmt)
+        created = time.strftime(outfmt, moment)
+
+        moment = time.strptime(fileinfo['modified'], infmt)
+        modified = time.strftime(outfmt, moment)
+
+        return (size, created, modified)
+
+    def __selected_entry(self):
         sel = self.__filelist.selection()
-        if len(sel) == 0: return # Deselect
+        if len(sel) == 0 or len(self.__listings) == 0: return None
 
-        sel = sel[0]
-        info = self.__listings[-1]['info']
-        path = info['path'] + sel
+        return self.__listing_entry(self.__listings[-1], int(sel[0]))
 
-        if 'dirs' in info and sel in info['dirs']:
-            listing = self.__client.list(path)
+    def __filelist_select(self, event):
+        entry = self.__selected_entry()
+        if entry == None: return # Deselect
+
+        path = self.__listings[-1]['path'] + entry['name']
+
+        if entry['dir']:
+            listing = self.__load_listing(path)
 
-            if listing != None and listing['status'] == 'ok':
+            if listing != None:
                 if len(self.__listings_forward) > 0:
-                    fwdpath = self.__listings_forward[-1]['info']['path'][:-1]
+                    fwdpath = self.__listings_forward[-1]['path'][:-1]
                     if fwdpath == path: self.__listings_forward.pop()
                     else: self.__listings_forward = []
 
-                self.__listing_fetch_details(listing)
                 self.__listings.append(listing)
                 self.__display_listing()
 
-        elif 'files' in info and sel in info['files']:
-            self.__download_file(path, sel)
+        else: self.__download_file(path, entry['name'])
+
+    def __filelist_menu_show(self, event):
+        row = self.__filelist.identify_row(event.y)
+        if row == '' or len(self.__listings) == 0: return
+
+        self.__filelist.selection_set(row)
+        self.__filelist_menu.tk_popup(event.x_root, event.y_root)
+
+    def __filelist_download(self):
+        entry = self.__selected_entry()
+        if entry == None: return
+
+        path = self.__listings[-1]['path'] + entry['name']
+
+        if entry['dir']: self.__download_folder(path, entry['name'])
+        else: self.__download_file(path, entry['name'])
 
     def disconnect(self, forquit=False):
         if self.__client != None:
@@ -310,3 +508,10 @@ class FileBrowser:
     def __download_file(self, path, name):
         if self.__file_downloader != None:
             self.__file_downloader(path, name)
+
+    def set_folder_downloader(self, downloader):
+        self.__folder_downloader = downloader
+
+    def __download_folder(self, path, name):
+        if self.__folder_downloader != None:
+            self.__folder_downloader(path, name)
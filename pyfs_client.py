@@ -1,24 +1,265 @@
+import os
 import math
 import io
 import time
+import json
 
+import struct
 import hashlib
 import pathlib
 import shelve
+import shutil
+import tarfile
 
+import queue
+import bisect
 import threading
+import itertools
+import collections
 import multiprocessing as mp
+import multiprocessing.connection
+from multiprocessing import shared_memory
+import concurrent.futures as futures
 
 import requests
 
 server_addr = 'http://127.0.0.1:8080'
-progress_storage = 'progress.shelf'
+progress_storage = 'progress.journal'
+
+# Where progress was saved before the journal, next to the journal. It is
+# read once into the journal and removed.
+progress_shelf_storage = 'progress.shelf'
+
+# Progress records are written out and synced at most this many seconds
+# apart, after the data they describe.
+progress_sync_interval = 1.0
+
+# The journal is rewritten with just the unfinished downloads once it has
+# this many records.
+progress_compact_records = 10000
+
+# Header the server sends the SHA-256 digest of a part in.
+part_hash_header = 'X-PyFS-SHA256'
+
+# Size of the blocks part data is read from the network in.
+part_read_block_size = 64 * 1024
+
+# How many directory listings are kept to revalidate with the server.
+listing_cache_size = 64
+
+# How many parts of each file are fetched at the same time, by how many
+# threads in all and how many parts may be asked of the server at once.
+download_parts_in_flight = 4
+download_threads_max = 16
+download_server_parts_max = 16
+
+# Which tasks of the same priority go first: 'fifo' in the order they were
+# added, 'smallest' the ones with the least left to download.
+download_policy = 'fifo'
+
+# Threads that list and create files for new downloads.
+task_starters_max = 2
+
+# Longest time in seconds to wait before asking again for a failed part.
+part_retry_wait_max = 30
+
+# Times parts of a download may fail one after another before it is given
+# up, about a minute with the waits in between.
+part_failures_max = 9
+
+# Parts are sized to take about this many seconds each to arrive, within the
+# bounds advertised by the server.
+part_target_time = 1.0
+part_size_min = 64 * 1024
+
+# Resumed and updated downloads are checked against the server's digests of
+# parts of this size, asked for this many at a time and hashed by this many
+# threads. A batch should be small enough for the server to hash within
+# request_read_timeout when it has no digests of the file yet.
+resume_verify_chunk_size = 4 * 1024 * 1024
+resume_verify_batch = 32
+resume_verify_threads = 4
+
+# Downloads checked at the same time. They have threads of their own so new
+# downloads start while others are being checked.
+resume_verify_tasks_max = 2
+
+# Seconds between the progress reports of the download process. Progress of
+# all downloads that moved is sent together in one message.
+progress_event_interval = 0.25
+
+# Downloads whose progress can be read from shared memory at the same time.
+# Progress of any beyond these is sent as messages.
+progress_table_slots = 16384
+
+# Files of a folder downloaded at the same time. The rest of the folder
+# waits its turn so open files stay few however large it is.
+folder_files_in_flight = 32
+
+# Seconds between progress events of a folder.
+folder_progress_interval = 0.5
+
+# Folders not downloaded before come as one tar archive, saving a request per
+# file, when the first files listed are on average no larger than this. The
+# archive can only be started over, so later downloads go file by file.
+folder_archive_file_size = 256 * 1024
+folder_archive_sample = 256
+
+# Persistent connections kept open to each server. Should be at least
+# download_threads_max so every download thread can keep its connection.
+connection_pool_size = 20
+
+# Seconds to wait for a server to take a connection and for each piece of
+# its answers before a request is given up.
+request_connect_timeout = 10
+request_read_timeout = 60
+
+write_at_lock = threading.Lock()
+
+# Writes data at offset in file whatever order parts arrive in.
+def write_at(file, data, offset):
+    if not hasattr(os, 'pwrite'): # Windows
+        with write_at_lock:
+            file.seek(offset, io.SEEK_SET)
+            file.write(data)
+            file.flush()
+
+        return
+
+    view = memoryview(data)
+
+    while len(view) > 0:
+        written = os.pwrite(file.fileno(), view, offset)
+        view = view[written:]
+        offset += written
+
+# SHA-256 of length bytes of the file at path from offset, or None if it
+# cannot be read.
+def hash_file_part(path, offset, length):
+    hash = hashlib.sha256()
+
+    try:
+        with open(path, 'rb') as file:
+            file.seek(offset, io.SEEK_SET)
+
+            while length > 0:
+                block = file.read(min(length, part_read_block_size * 16))
+                if len(block) == 0: break
+
+                hash.update(block)
+                length -= len(block)
+
+    except OSError: return None
+
+    return hash.hexdigest()
+
+# Where a path sent by the server goes below the local directory root, or
+# None if it would end up outside it.
+def local_path(root, path):
+    parts = pathlib.PurePosixPath(path).parts
+
+    if len(parts) == 0 or parts[0] == '/' or '..' in parts: return None
+    return root.joinpath(*parts)
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+# One pool of persistent connections per server in each process. Processes
+# get their own as connections cannot be shared with a forked child.
+def get_session(addr):
+    key = (os.getpid(), addr)
+
+    with sessions_lock:
+        if key not in sessions:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=connection_pool_size
+            )
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[key] = session
+
+        return sessions[key]
+
+# Adds the byte range start to end to a sorted list of non-overlapping ranges
+def ranges_add(ranges, start, end):
+    index = bisect.bisect_left(ranges, (start, end))
+
+    if index > 0 and ranges[index - 1][1] >= start:
+        index -= 1
+        start = ranges[index][0]
+
+    # Takes in every range after that it reaches
+    last = index
+
+    while last < len(ranges) and ranges[last][0] <= end:
+        end = max(end, ranges[last][1])
+        last += 1
+
+    ranges[index:last] = [(start, end)]
+
+# The first byte range at or after offset missing from ranges
+def ranges_gap(ranges, offset, size):
+    for first, last in ranges:
+        if last <= offset: continue
+        if first > offset: return offset, first
+
+        offset = last
+
+    if offset < size: return offset, size
+    else: return None
+
+def ranges_size(ranges):
+    return sum([last - first for first, last in ranges])
+
+# Turns progress saved as done part numbers into done byte ranges
+def task_ranges_from_parts(task):
+    size = task['listing']['info']['size']
+    chunksize = task['chunksize']
+
+    if 'partsdone' in task: parts = sorted(task['partsdone'])
+    else: parts = range(task['nextpart'])
+
+    task['size'] = size
+    task['ranges'] = []
+
+    for part in parts:
+        start = part * chunksize
+        ranges_add(task['ranges'], start, min(start + chunksize, size))
+
+    for key in ('partsdone', 'nextpart', 'maxparts'):
+        if key in task: del task[key]
+
+# The largest power of two part size up to wanted that a part starting at
+# offset can have, so it is a whole part for the server. Parts past limit
+# are only allowed at the end of the file, which the server cuts short.
+# Offsets must be a multiple of smallest.
+def aligned_part_size(offset, wanted, limit, smallest, largest):
+    if offset % smallest != 0: return None
+
+    size = largest
+
+    while size > smallest and (size > wanted or size > limit):
+        size //= 2
+
+    while size > smallest and offset % size != 0: size //= 2
+
+    return size
 
 class ClientLogic:
+    def __get(self, path, **params):
+        session = get_session(self.__server_addr)
+        timeout = (request_connect_timeout, request_read_timeout)
+
+        return session.get(
+            self.__server_addr + path, timeout=timeout, **params
+        )
+
     def get_json_from(self, path='', params=None, bypass=False):
         if not self.__server_ok and not bypass: return None
 
-        try: request = requests.get(self.__server_addr + path, params = params)
+        try: request = self.__get(path, params=params)
         except: return None
 
         if request.status_code != requests.codes.ok: return None
@@ -31,7 +272,7 @@ class ClientLogic:
     def get_bytes_from(self, path='', params=None, bypass=False):
         if not self.__server_ok and not bypass: return None
 
-        try: request = requests.get(self.__server_addr + path, params = params)
+        try: request = self.__get(path, params=params)
         except: return None
 
         if request.status_code != requests.codes.ok: return None
@@ -41,6 +282,8 @@ class ClientLogic:
     def __init__(self, addr):
         self.__server_addr = addr
         self.__server_ok = False
+        self.__listings = collections.OrderedDict()
+        self.__listings_lock = threading.Lock() # Listed from many threads
 
         response = self.get_json_from(bypass=True)
 
@@ -51,16 +294,226 @@ class ClientLogic:
         self.__server_ok = True
         self.__server_name = response['servername']
         self.__server_chunkdefault = response['chunkdefault']
+        self.__server_chunkmin = response['chunkmin']
+        self.__server_chunkmax = response['chunkmax']
 
     def server_ok(self): return self.__server_ok
 
+    # Requests sent and connections opened to the server by this process.
+    # Requests above the connection count went over a reused connection.
+    def pool_stats(self):
+        stats = {'requests': 0, 'connections': 0, 'reused': 0}
+        session = get_session(self.__server_addr)
+        adapter = session.get_adapter(self.__server_addr)
+        pools = adapter.poolmanager.pools
+
+        for key in pools.keys():
+            pool = pools[key]
+            if pool == None: continue
+
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+
+        stats['reused'] = stats['requests'] - stats['connections']
+        return stats
+
     def server_name(self):
         if self.__server_ok: return self.__server_name
 
     def server_chunkdefault(self):
         if self.__server_ok: return self.__server_chunkdefault
 
-    def list(self, path=''): return self.get_json_from('/list/' + path)
+    # Smallest and largest power of two part sizes the server accepts
+    def server_chunkbounds(self):
+        if not self.__server_ok: return None
+
+        smallest, largest = 1, 1
+        wanted = max(self.__server_chunkmin, part_size_min)
+
+        while smallest < wanted: smallest *= 2
+        while largest * 2 <= self.__server_chunkmax: largest *= 2
+
+        if smallest > largest: return None
+        else: return smallest, largest
+
+    # Listings are kept and revalidated with the server, which answers with no
+    # body when nothing changed. The same listing object is returned each
+    # time then so callers must not modify it.
+    def list(self, path=''): return self.__list_cached(path, {})
+
+    # Pages of listings are kept apart by their parameters
+    def __list_cached(self, path, params):
+        if not self.__server_ok: return None
+
+        key = (path, tuple(sorted(params.items())))
+        headers = {}
+
+        with self.__listings_lock: cached = self.__listings.get(key)
+
+        if cached != None: headers['If-None-Match'] = cached[0]
+
+        try:
+            request = self.__get(
+                '/list/' + path, params=params, headers=headers
+            )
+
+        except: return None
+
+        if request.status_code == requests.codes.not_modified:
+            if cached == None: return None
+
+            with self.__listings_lock:
+                if key in self.__listings: self.__listings.move_to_end(key)
+
+            return cached[1]
+
+        if request.status_code != requests.codes.ok: return None
+
+        try: response = request.json()
+        except ValueError: return None
+
+        tag = request.headers.get('ETag')
+
+        with self.__listings_lock:
+            if tag != None and response.get('status') == 'ok':
+                self.__listings[key] = (tag, response)
+                self.__listings.move_to_end(key)
+
+                if len(self.__listings) > listing_cache_size:
+                    self.__listings.popitem(last=False)
+
+            else: self.__listings.pop(key, None)
+
+        return response
+
+    # One page of a directory listing. Pass the 'next' cursor of a page as
+    # after to get the page that follows it. Pages are kept and revalidated
+    # like listings.
+    def list_page(self, path, offset=0, limit=None, after=None, sort=True):
+        params = {'offset': offset}
+
+        if limit != None: params['limit'] = limit
+        if after != None: params['after'] = after
+        if not sort: params['sort'] = 'none'
+
+        return self.__list_cached(path, params)
+
+    # Yields the lines of a JSON lines stream up to its closing line. A
+    # stream cut short or with a broken line ends with an error line instead
+    # so it is not taken for a whole one.
+    def __get_ndjson_from(self, path, params):
+        if not self.__server_ok: return
+
+        try: request = self.__get(path, params=params, stream=True)
+        except: return
+
+        cut = {'status': 'error', 'reason': 'cut short'}
+
+        try:
+            if request.status_code != requests.codes.ok: return
+
+            type = request.headers.get('Content-Type', '')
+            if not type.startswith('application/x-ndjson'): return
+
+            for line in request.iter_lines():
+                if len(line) == 0: continue
+
+                try: item = json.loads(line)
+                except ValueError:
+                    yield cut
+                    return
+
+                if item.get('status') == 'end': return
+                yield item
+
+            yield cut
+
+        except requests.RequestException: yield cut
+
+        finally: request.close()
+
+    # Yields the directory listing first and then one dict per entry as they
+    # arrive. Nothing is yielded if the path is not a directory. A listing
+    # cut short ends with a dict with 'status' 'error'.
+    def list_stream(self, path, sort=False):
+        params = {'format': 'ndjson'}
+        if sort: params['sort'] = 'name'
+
+        return self.__get_ndjson_from('/list/' + path, params)
+
+    # Like list_stream for the whole tree below path, down to depth levels.
+    # Entries carry their path below the listed directory.
+    def list_tree(self, path, depth=None, include=(), exclude=()):
+        params = {'include': list(include), 'exclude': list(exclude)}
+        if depth != None: params['depth'] = depth
+
+        return self.__get_ndjson_from('/tree/' + path, params)
+
+    # Returns (data, sha256) with the digest checked as the data arrives or
+    # None if the part could not be fetched or did not match its digest.
+    def getpart(self, path, part, chunksize=None):
+        data = bytearray()
+
+        fetched = self.__stream_part(path, part, chunksize, data.extend)
+        if fetched == None: return None
+
+        return bytes(data), fetched[1]
+
+    # Like getpart, but writes the part to file at offset as it arrives and
+    # returns the length and digest. Only one block is held in memory at a
+    # time. What was written is left in place when the part fails, to be
+    # written over when it is fetched again.
+    def getpart_into(self, file, offset, path, part, chunksize=None):
+        position = offset
+
+        def write(block):
+            nonlocal position
+            write_at(file, block, position)
+            position += len(block)
+
+        return self.__stream_part(path, part, chunksize, write)
+
+    # Hands the blocks of a part to consume as they arrive, hashing them on
+    # the way, and returns the length and digest if they match the server's.
+    def __stream_part(self, path, part, chunksize, consume):
+        if not self.__server_ok: return None
+
+        try:
+            params = {'part': int(part)}
+            if chunksize != None: params['chunksize'] = int(chunksize)
+
+        except ValueError: return None
+
+        try: request = self.__get('/get/' + path, params=params, stream=True)
+        except: return None
+
+        length = 0
+
+        try:
+            if request.status_code != requests.codes.ok: return None
+
+            type = request.headers.get('Content-Type', '')
+            if not type.startswith('application/octet-stream'): return None
+
+            hash = hashlib.sha256()
+
+            for block in request.iter_content(part_read_block_size):
+                hash.update(block)
+                consume(block)
+                length += len(block)
+
+        except: return None
+
+        finally: request.close()
+
+        digest = request.headers.get(part_hash_header)
+
+        # Servers that do not send the digest along are asked separately
+        if digest == None: digest = self.gethash(path, part, chunksize)
+
+        if digest == None or digest != hash.hexdigest(): return None
+
+        return length, digest
 
     def gethash(self, from_, part=None, chunksize = None):
 
@@ -81,314 +534,1458 @@ class ClientLogic:
         if hash['status'] != 'ok': return None
         if 'sha256' in hash: return hash['sha256']
 
+    # Digests of parts first to first + count - 1 (all when count is None)
+    def gethashes(self, path, first=0, count=None, chunksize=None):
+        try:
+            params = {'first': int(first)}
+            if count != None: params['count'] = int(count)
+            if chunksize != None: params['chunksize'] = int(chunksize)
+
+        except ValueError: return None
+
+        hashes = self.get_json_from('/hashes/' + path, params=params)
+
+        if hashes == None: return None
+        if hashes['status'] != 'ok': return None
+        if 'sha256' in hashes: return hashes['sha256']
+
+    # Downloads a directory as a tar archive and unpacks it under dest while
+    # it arrives. progress is called with the bytes received so far and may
+    # return False to stop. Returns True if the whole directory was unpacked.
+    def getarchive(self, path, dest, progress=None):
+        if not self.__server_ok: return False
+
+        try: request = self.__get('/archive/' + path, stream=True)
+        except: return False
+
+        try:
+            if request.status_code != requests.codes.ok: return False
+
+            type = request.headers.get('Content-Type', '')
+            if not type.startswith('application/x-tar'): return False
+
+            request.raw.decode_content = True
+            stream = ArchiveStream(request.raw, progress)
+
+            with tarfile.open(fileobj=stream, mode='r|') as archive:
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extraction_filter = tarfile.data_filter
+
+                for member in archive:
+                    if stream.stopped: return False
+                    if not (member.isfile() or member.isdir()): continue
+
+                    name = pathlib.PurePosixPath(member.name)
+                    if name.is_absolute() or '..' in name.parts: continue
+
+                    archive.extract(member, dest)
+
+            return not stream.stopped
+
+        except: return False
+
+        finally: request.close()
+
+# Reads an archive download for tarfile, reporting the bytes read so far to
+# progress. The download is stopped when progress returns False.
+class ArchiveStream:
+    def __init__(self, raw, progress):
+        self.__raw = raw
+        self.__progress = progress
+        self.__read = 0
+        self.stopped = False
+
+    def read(self, size=-1):
+        if self.stopped: return b''
+
+        data = self.__raw.read(size)
+        self.__read += len(data)
+
+        if self.__progress != None and self.__progress(self.__read) == False:
+            self.stopped = True
+
+        return data
+
+# Download progress as an append-only journal of JSON records, one per line.
+# A record only reaches the disk after the file data it describes, so after a
+# crash the journal never claims more than was written. Records cut short by
+# a crash are skipped when read back.
+class ProgressJournal:
+    def __init__(self, path):
+        self.__path = pathlib.Path(path)
+        self.__file = None
+        self.__records = 0
+        self.__pending = []
+        self.__dirty = {} # Files written since the last sync by path
+        self.__lastsync = time.monotonic()
+
+    # Reads back the unfinished downloads and starts a fresh journal for them
+    def load(self):
+        tasks = self.__load_shelf()
+
+        try:
+            with open(self.__path, 'r', encoding='utf-8') as file:
+                for line in file: self.__replay(tasks, line)
+
+        except OSError: pass
+
+        tasks = list(tasks.values())
+        self.__compact(tasks)
+        return tasks
+
+    def __replay(self, tasks, line):
+        try: record = json.loads(line)
+        except ValueError: return
+
+        if type(record) != type({}) or 'path' not in record: return
+
+        op = record.pop('op', None)
+        path = record.pop('path')
+
+        if op == 'task':
+            record['ranges'] = [tuple(range) for range in record['ranges']]
+            tasks.pop(path, None)
+            tasks[path] = record
+
+        elif path not in tasks: return
+
+        elif op == 'range':
+            ranges_add(tasks[path]['ranges'], record['start'], record['end'])
+
+        elif op == 'set': tasks[path].update(record['fields'])
+        elif op == 'remove': del tasks[path]
+
+    # Progress saved by earlier versions as a shelve snapshot
+    def __load_shelf(self):
+        tasks = {}
+        shelfpath = self.__path.with_name(progress_shelf_storage)
+
+        if self.__path.exists(): return tasks
+
+        try: progress = shelve.open(str(shelfpath), flag='r')
+        except: return tasks
+
+        try: saved = progress.get('getfile_tasks', [])
+        except: saved = []
+
+        progress.close()
+
+        for task in saved:
+            if task['done']: continue
+
+            # Progress saved by part numbers before parts changed size
+            if 'ranges' not in task: task_ranges_from_parts(task)
+
+            tasks[task['listing']['info']['path']] = self.__snapshot(task)
+
+        for suffix in ('', '.dat', '.dir', '.bak', '.db'):
+            try: os.unlink(str(shelfpath) + suffix)
+            except OSError: pass
+
+        return tasks
+
+    def __snapshot(self, task):
+        return {
+            'listing': task['listing'], 'size': task['size'],
+            'ranges': list(task['ranges']), 'chunksize': task['chunksize'],
+            'priority': task.get('priority', 0), 'saveto': task['saveto'],
+            'paused': task['paused'], 'created': task.get('created', True)
+        }
+
+    def __append(self, task, op, **fields):
+        record = {'op': op, 'path': task['listing']['info']['path']}
+        record.update(fields)
+        self.__pending.append(json.dumps(record) + '\n')
+
+    def add(self, task):
+        self.__append(task, 'task', **self.__snapshot(task))
+
+    def written(self, task, start, end):
+        self.__append(task, 'range', start=start, end=end)
+        self.__dirty[task['saveto']] = task['file']
+
+    def update(self, task, **fields): self.__append(task, 'set', fields=fields)
+
+    # The file of a finished download is synced before it is closed, so its
+    # removal can go out with the next records
+    def finished(self, task):
+        self.__dirty.pop(task['saveto'], None)
+
+        try: os.fsync(task['file'].fileno())
+        except (OSError, ValueError): pass
+
+        self.__append(task, 'remove')
+
+    def canceled(self, task):
+        self.__dirty.pop(task['saveto'], None)
+        self.__append(task, 'remove')
+
+    # Seconds until the records kept back are due to be written out, or None
+    # if there are none
+    def due(self):
+        if len(self.__pending) == 0: return None
+
+        elapsed = time.monotonic() - self.__lastsync
+        return max(progress_sync_interval - elapsed, 0)
+
+    # Writes out the records kept back if it is time to. Rewrites the journal
+    # with tasks when it has grown too long.
+    def sync(self, tasks, force=False):
+        if len(self.__pending) == 0: return
+
+        now = time.monotonic()
+        if not force and now - self.__lastsync < progress_sync_interval: return
+
+        self.__lastsync = now
+
+        if tasks != None and self.__records >= progress_compact_records:
+            self.__compact(tasks)
+            return
+
+        self.__sync_files()
+
+        try:
+            if self.__file == None:
+                self.__file = open(self.__path, 'a', encoding='utf-8')
+
+            self.__file.writelines(self.__pending)
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+
+        except OSError: pass
+
+        self.__records += len(self.__pending)
+        self.__pending = []
+
+    def __sync_files(self):
+        for file in self.__dirty.values():
+            try: os.fsync(file.fileno())
+            except (OSError, ValueError): pass
+
+        self.__dirty = {}
+
+    # Replaces the journal with one record per task
+    def __compact(self, tasks):
+        self.__sync_files()
+        self.__pending = []
+        self.__records = len(tasks)
+
+        if self.__file != None: self.__file.close()
+        self.__file = None
+
+        if len(tasks) == 0:
+            self.__path.unlink(missing_ok=True)
+            return
+
+        temppath = self.__path.with_name(self.__path.name + '.tmp')
+
+        try:
+            with open(temppath, 'w', encoding='utf-8') as file:
+                for task in tasks:
+                    record = {
+                        'op': 'task', 'path': task['listing']['info']['path']
+                    }
+
+                    record.update(self.__snapshot(task))
+                    file.write(json.dumps(record) + '\n')
+
+                file.flush()
+                os.fsync(file.fileno())
+
+            os.replace(temppath, self.__path)
+
+        except OSError: pass
+
+        # Make the rename itself durable where directories can be synced
+        try:
+            dir = os.open(self.__path.resolve().parent, os.O_RDONLY)
+
+            try: os.fsync(dir)
+            finally: os.close(dir)
+
+        except OSError: pass
+
+    def close(self, tasks): self.__compact(tasks)
+
+# Live progress of downloads in shared memory. The download process writes
+# it and other processes read it without it going through the events pipe.
+# Each download has a record at its slot with its id, so a slot taken over by
+# another download is not mistaken for it. Records are written under a
+# sequence number that is odd while a write is under way.
+class ProgressTable:
+    record = struct.Struct('<QQqqddd')
+    sequence = struct.Struct('<Q')
+
+    def __init__(self, slots=progress_table_slots):
+        self.__memory = shared_memory.SharedMemory(
+            create=True, size=self.record.size * slots
+        )
+
+        self.__free = list(range(slots - 1, -1, -1))
+
+    # Used by the download process only
+    def claim(self, id):
+        if len(self.__free) == 0: return None
+
+        slot = self.__free.pop()
+        self.write(slot, id, 0, 0, 0, 0, None)
+        return slot
+
+    def free(self, slot):
+        self.write(slot, 0, 0, 0, 0, 0, None)
+        self.__free.append(slot)
+
+    def write(self, slot, id, bytesdone, size, rate, avgrate, eta):
+        buffer = self.__memory.buf
+        offset = slot * self.record.size
+
+        sequence = self.sequence.unpack_from(buffer, offset)[0] + 1
+        if eta == None: eta = -1
+
+        self.sequence.pack_into(buffer, offset, sequence)
+
+        self.record.pack_into(
+            buffer, offset, sequence, id, bytesdone, size, rate, avgrate, eta
+        )
+
+        self.sequence.pack_into(buffer, offset, sequence + 1)
+
+    # Returns the progress at slot if it is still the download id's, or None
+    def read(self, slot, id):
+        buffer = self.__memory.buf
+        offset = slot * self.record.size
+
+        for unused in range(100):
+            record = self.record.unpack_from(buffer, offset)
+            sequence = record[0]
+
+            if sequence % 2 == 1: continue
+            if self.sequence.unpack_from(buffer, offset)[0] != sequence: continue
+
+            if record[1] != id: return None
+
+            return {
+                'bytesdone': record[2], 'size': record[3], 'rate': record[4],
+                'avgrate': record[5], 'eta': None if record[6] < 0 else record[6]
+            }
+
+        return None
+
+    def close(self): self.__memory.close()
+    def unlink(self): self.__memory.unlink()
+
 class DownloadManager(ClientLogic):
     def __init__(self, addr, progress_storage):
         ClientLogic.__init__(self, addr)
         self.__progress_storage = progress_storage
 
-    def getfile_proc_fun(self, pipe):
-        tasks = []
-        active_task_count = 0
+    # Lists the file and creates it. Runs on a worker thread so a slow server
+    # path does not hold up commands and the other downloads. Files that are
+    # updated are opened as they are, with what they have in common with the
+    # server's file as 'verify' to be checked before it counts as done. Only
+    # files the task 'created' are removed when it is cancelled.
+    def __start_task(self, data):
+        if 'info' in data:
+            listing = {'status': 'ok', 'type': 'file', 'info': data['info']}
 
-        try: progress = shelve.open(self.__progress_storage, flag='r')
-        except: progress = None
+        else: listing = self.list(data['path'])
 
-        if progress != None and 'getfile_tasks' in progress:
-            tasks = progress['getfile_tasks']
+        listed = listing != None and listing['status'] == 'ok'
 
-            for task in tasks:
-                if task['done']: continue
+        if not listed or listing['type'] != 'file': return None
 
-                try: file = open(task['saveto'], 'r+b')
-                except OSError: file = None
+        size = listing['info']['size']
 
-                if file != None:
-                    file.seek(0, io.SEEK_END) # Seek to end of file
-                    task['file'] = file
-                    task['lasttime'] = time.monotonic()
+        if 'saveto' in data: destpath = data['saveto']
+        else: destpath = listing['info']['name']
 
-                    partdone = task['nextpart']
-                    if partdone > 0: partdone -= 1
+        destpath = str(pathlib.Path(destpath).resolve())
+        verify = []
+        created = True
 
-                    if task['paused']: status = 'filepaused'
+        try:
+            if 'update' in data and data['update']:
+                try:
+                    file = open(destpath, 'r+b')
+                    created = False
 
-                    else:
-                        status = 'fileresumed'
-                        active_task_count += 1
+                except FileNotFoundError: file = open(destpath, 'w+b')
 
-                    pipe.send({
-                        'status': status,
-                        'name': task['listing']['info']['name'],
-                        'path': task['listing']['info']['path'],
-                        'partdone': partdone, 'partmax': task['maxparts']
-                    })
+                ondisk = os.fstat(file.fileno()).st_size
+                if ondisk > size: file.truncate(size)
+                if min(ondisk, size) > 0: verify = [(0, min(ondisk, size))]
 
-        if progress != None: progress.close()
+            else: file = open(destpath, 'w+b')
 
-        while True:
-            if active_task_count > 0: data_available = pipe.poll()
-            else: data_available = pipe.poll(None) # Blocking wait
+        except OSError: return None
 
-            if data_available: data = pipe.recv()
-            else: data = None
+        if 'priority' in data: priority = data['priority']
+        else: priority = 0
 
-            if type(data) == type({}) and 'command' in data:
-                if data['command'] == 'stop': break
+        return {
+            'listing': listing, 'size': size, 'ranges': [],
+            'chunksize': self.server_chunkdefault(), 'priority': priority,
+            'file': file, 'saveto': destpath, 'done': False, 'paused': False,
+            'verify': verify, 'created': created
+        }
 
-                elif data['command'] == 'file':
-                    succeed = False
-                    listing = self.list(data['path'])
-                    listed = listing != None and listing['status'] == 'ok'
+    # Fetches the part at offset and writes it there. Runs on the worker
+    # threads and returns the data length and the time taken, or None if the
+    # part has to be fetched again.
+    def __fetch_part(self, file, path, offset, chunksize):
+        timestart = time.monotonic()
+        fetched = self.getpart_into(
+            file, offset, path, offset // chunksize, chunksize
+        )
 
-                    if listed and listing['type'] == 'file':
-                        size = listing['info']['size']
-                        chunksize = self.server_chunkdefault()
+        if fetched == None: return None
 
-                        if size == 0: maxparts = -1
-                        else: maxparts = math.floor(size / chunksize)
+        return fetched[0], time.monotonic() - timestart
 
-                        if 'saveto' in data: destpath = data['saveto']
-                        else: destpath = listing['info']['name']
+    # Picks the next part of a task as (offset, part size). Parts are whole
+    # server parts of the task's current part size or smaller.
+    def __next_part(self, task):
+        bounds = self.server_chunkbounds()
 
-                        destpath = str(pathlib.Path(destpath).resolve())
+        retrying = len(task['retry']) > 0
 
-                        try: file = open(destpath, 'w+b')
-                        except OSError: file = None
+        if retrying: gap = task['retry'].pop(0)
+        else: gap = ranges_gap(task['ranges'], task['nextoffset'], task['size'])
 
-                        if file != None:
-                            task = {
-                                'listing': listing, 'chunksize': chunksize,
-                                'nextpart': 0, 'maxparts': maxparts,
-                                'file': file, 'saveto': destpath,
-                                'done': False, 'paused': False,
-                                'lasttime': time.monotonic()
-                            }
+        if gap == None: return None
 
-                            tasks.append(task)
-                            succeed = True
+        start, end = gap
 
-                    if succeed: pipe.send({
-                        'status': 'filestarted', 'path': data['path'],
-                        'name': listing['info']['name']
-                    })
+        if bounds == None: # Server part sizes are not powers of two
+            chunksize = self.server_chunkdefault()
+            start -= start % chunksize
 
-                    else: pipe.send({
-                        'status': 'fileerror', 'path': data['path']
-                    })
+        else:
+            # Gaps left by ranges cut short may start inside a part
+            start -= start % bounds[0]
 
-                elif data['command'] == 'pause' or data['command'] == 'resume':
-                    if data['command'] == 'pause': paused = True
-                    else: paused = False
+            if end < task['size']: limit = end - start
+            else: limit = math.inf
 
-                    for task in tasks:
-                        if 'target' in data:
-                            path = task['listing']['info']['path']
-                            matches = path == data['target']
+            chunksize = aligned_part_size(
+                start, task['chunksize'], limit, bounds[0], bounds[1]
+            )
 
-                        else: matches = True
+        partend = min(start + chunksize, task['size'])
 
-                        if not (task['done'] or task['paused'] == paused) and matches:
-                            task['paused'] = paused
+        if retrying:
+            if partend < end: task['retry'].insert(0, (partend, end))
 
-                            if not paused:
-                                task['lasttime'] = time.monotonic()
+        else: task['nextoffset'] = partend
 
-                            pipe.send({
-                                'status': 'file' + data['command'] + 'd',
-                                'path': task['listing']['info']['path'],
-                                'partdone': task['nextpart'],
-                                'partmax': task['maxparts']
-                            })
+        return start, chunksize
 
-                elif data['command'] == 'cancel' and 'target' in data:
-                    tasksleft = []
+    # Sizes the next parts of a task for the rate its last part came in at.
+    # Part sizes at most double at a time and halve when a part fails.
+    def __adapt_part_size(self, task, length, timetaken):
+        bounds = self.server_chunkbounds()
+        if bounds == None: return
 
-                    for task in tasks:
-                        path = task['listing']['info']['path']
+        if length == None: wanted = task['chunksize'] // 2
 
-                        if data['target'] == path and not task['done']:
-                            task['file'].close()
-                            dest = task['saveto']
-                            pathlib.Path(dest).unlink(missing_ok=True)
+        else:
+            rate = length / max(timetaken, 0.001)
 
-                            pipe.send({
-                                'status': 'filecanceled', 'path': path
-                            })
+            if task['rate'] == None: task['rate'] = rate
+            else: task['rate'] = 0.7 * task['rate'] + 0.3 * rate
 
-                        else: tasksleft.append(task)
+            wanted = min(task['rate'] * part_target_time, task['chunksize'] * 2)
 
-                    tasks = tasksleft
+        task['chunksize'] = max(min(int(wanted), bounds[1]), bounds[0])
 
-            active_task_count = 0
+    # Hashes the done parts of a resumed download on the verifier threads and
+    # compares them with the server's digests, asked for a batch at a time.
+    # Returns the ranges that matched and whether all parts could be checked,
+    # or None if stopped. Parts only partly done are left to be fetched again.
+    def __verify_task(self, task, ranges, verifiers, stopping):
+        bounds = self.server_chunkbounds()
 
-            for task in tasks:
-                if task['paused']: continue
+        if bounds == None: chunksize = self.server_chunkdefault()
 
-                if task['nextpart'] > task['maxparts']:
-                    task['file'].close()
-                    task['done'] = True
+        else:
+            chunksize = max(resume_verify_chunk_size, bounds[0])
+            chunksize = min(chunksize, bounds[1])
 
-                else: active_task_count += 1
+        if chunksize == None: return [], False
 
-                params = {
-                    'part': task['nextpart'], 'chunksize': task['chunksize']
-                }
+        size = task['size']
+        path = task['listing']['info']['path']
+
+        def part_range(part):
+            return part * chunksize, min((part + 1) * chunksize, size)
+
+        parts = []
+
+        for first, last in ranges:
+            part = math.ceil(first / chunksize)
+
+            while part * chunksize < last and part_range(part)[1] <= last:
+                parts.append(part)
+                part += 1
+
+        verified = []
+
+        for index in range(0, len(parts), resume_verify_batch):
+            batch = parts[index : index + resume_verify_batch]
 
+            hashing = [
+                verifiers.submit(
+                    hash_file_part, task['saveto'], start, end - start
+                )
+                for start, end in map(part_range, batch)
+            ]
+
+            # Batches may skip parts, which are asked for and not used
+            digests = self.gethashes(
+                path, batch[0], batch[-1] - batch[0] + 1, chunksize
+            )
+
+            if digests == None:
+                for future in hashing: future.cancel()
+                return verified, False
+
+            for part, future in zip(batch, hashing):
+                if stopping.is_set():
+                    for future in hashing: future.cancel()
+                    return None
+
+                digest = future.result()
+                wanted = part - batch[0]
+
+                if digest != None and wanted < len(digests):
+                    if digest == digests[wanted]:
+                        ranges_add(verified, *part_range(part))
+
+        return verified, True
+
+    # Tasks are served by priority, then by the download policy and then in
+    # the order they were added or moved to.
+    def __task_rank(self, task):
+        if download_policy == 'smallest':
+            remaining = task['size'] - ranges_size(task['ranges'])
+
+        else: remaining = 0
+
+        return -task['priority'], remaining, task['order']
+
+    # Hands free download slots to the best ranked tasks. Returns how long
+    # until a task waiting after a failed part may be tried again.
+    def __schedule(self, tasks, fetching, submit):
+        slots = min(download_threads_max, download_server_parts_max)
+        slots -= len(fetching)
+
+        now = time.monotonic()
+        retrywait = None
+        runnable = []
+
+        for task in tasks:
+            if task['paused'] or task['done'] or task['verifying']: continue
+            if task['failed'] or task['canceled']: continue
+
+            if task['retryat'] > now:
+                wait = task['retryat'] - now
+                if retrywait == None or wait < retrywait: retrywait = wait
+
+            elif task['inflight'] < download_parts_in_flight:
+                runnable.append(task)
+
+        if slots > 0 and len(runnable) > 0:
+            runnable.sort(key=self.__task_rank)
+
+            for task in runnable:
                 path = task['listing']['info']['path']
-                timestart = time.monotonic()
 
-                data = self.get_bytes_from('/get/' + path, params=params)
-                if data == None: continue
+                while slots > 0 and task['inflight'] < download_parts_in_flight:
+                    part = self.__next_part(task)
+                    if part == None: break
 
-                hash = self.gethash(path, params['part'])
-                if hash == None or hash != self.gethash(data): continue
+                    offset, chunksize = part
 
-                task['file'].write(data)
-                timeend = time.monotonic()
-                timetaken = timeend - task['lasttime']
-                task['lasttime'] = timeend
+                    future = submit(
+                        self.__fetch_part, task['file'], path, offset,
+                        chunksize
+                    )
 
-                pipe.send({
-                    'status': 'fileprogress', 'path': path,
-                    'partdone': task['nextpart'], 'partmax': task['maxparts'],
-                    'partsize': len(data) + len(hash), 'timetaken': timetaken
-                })
+                    fetching[future] = (task, offset, chunksize)
+                    task['inflight'] += 1
+                    slots -= 1
 
-                task['nextpart'] += 1
+                if slots == 0: break
 
-            tasksleft = []
-            index = 0
+        return retrywait
+
+    # Runs the downloads in their own process. Commands arrive on commands
+    # and events go out on events. Progress goes to table, or out as events
+    # for downloads it has no room for.
+    def getfile_proc_fun(self, commands, events, table):
+        tasks = []
+        orders = itertools.count()
+        ids = itertools.count(1)
+        retrywait = None
+        lastreport = 0
+
+        journal = ProgressJournal(self.__progress_storage)
+
+        fetching = {} # Parts in flight as future: (task, offset, size)
+        starting = {} # Tasks being started as future: command
+        workers = futures.ThreadPoolExecutor(max_workers=download_threads_max)
+        starters = futures.ThreadPoolExecutor(max_workers=task_starters_max)
+
+        verifying = {} # Resumed tasks being checked as future: task
+        checkers = futures.ThreadPoolExecutor(
+            max_workers=resume_verify_tasks_max
+        )
+
+        verifiers = futures.ThreadPoolExecutor(
+            max_workers=resume_verify_threads
+        )
+
+        stopping = threading.Event()
+
+        # Threads wake the loop up when they finish something, so it only
+        # ever sleeps until there is something to do.
+        wakeup, waker = mp.Pipe(duplex=False)
+        waker_lock = threading.Lock()
+
+        def wake(future):
+            with waker_lock: waker.send_bytes(b'')
+
+        def watched(future):
+            future.add_done_callback(wake)
+            return future
+
+        def submit_part(*args): return watched(workers.submit(*args))
+
+        def task_ready(task):
+            task['order'] = next(orders)
+            task['id'] = next(ids)
+            task['slot'] = table.claim(task['id'])
+            task['progress'] = progress_start(task)
+            task['nextoffset'] = 0
+            task['rate'] = None
+            task['retry'] = []
+            task['inflight'] = 0
+            task['failures'] = 0
+            task['retryat'] = 0
+            task['failed'] = False
+            task['canceled'] = False
+            task['verifying'] = False
+            tasks.append(task)
+
+        def task_started(future):
+            data = starting.pop(future)
+
+            try: task = future.result()
+            except Exception: task = None
+
+            if task == None:
+                events.send({'status': 'fileerror', 'path': data['path']})
+                return
+
+            verify = task.pop('verify')
+            task_ready(task)
+            journal.add(task)
+
+            events.send({
+                'status': 'filestarted', 'path': data['path'],
+                'name': task['listing']['info']['name'],
+                'slot': task['slot'], 'id': task['id']
+            })
+
+            # Parts of an updated file that match the server's are kept
+            if len(verify) > 0: task_verify(task, verify)
+
+        # Checks ranges of a task's file, which is not scheduled meanwhile.
+        # Ranges that match the server's become the task's done ranges.
+        def task_verify(task, ranges):
+            task['verifying'] = True
+
+            future = watched(checkers.submit(
+                self.__verify_task, task, ranges, verifiers, stopping
+            ))
+
+            verifying[future] = task
+
+        def task_verified(future):
+            task = verifying.pop(future)
+            task['verifying'] = False
+
+            # Cancelled while it was being checked
+            if task['canceled']: return
+
+            try: verified = future.result()
+            except Exception: verified = [], False
+
+            if verified == None: return # Stopping
+
+            # Parts that could not be checked are fetched again
+            ranges, checked = verified
+
+            if ranges != task['ranges']:
+                task['ranges'] = ranges
+                task['progress'] = progress_start(task)
+                journal.add(task)
+
+            if task['paused']: status = 'filepaused'
+            else: status = 'fileresumed'
+
+            event = {
+                'status': status,
+                'path': task['listing']['info']['path'],
+                'bytesdone': ranges_size(task['ranges']),
+                'size': task['size']
+            }
+
+            if not checked: event['unverified'] = True
+            events.send(event)
+
+        def part_fetched(future):
+            task, offset, chunksize = fetching.pop(future)
+            task['inflight'] -= 1
+
+            fetched = future.result()
+
+            # Back off from a failing file so it does not crowd out the rest
+            if fetched == None:
+                end = min(offset + chunksize, task['size'])
+                task['retry'].append((offset, end))
+
+                # Parts that were in flight together fail as one
+                if task['retryat'] <= time.monotonic(): task['failures'] += 1
+                if task['failures'] >= part_failures_max: task['failed'] = True
+
+                wait = min(2 ** task['failures'] / 10, part_retry_wait_max)
+                task['retryat'] = time.monotonic() + wait
+                self.__adapt_part_size(task, None, None)
+                return
+
+            length, fetchtime = fetched
+            ranges_add(task['ranges'], offset, offset + length)
+            journal.written(task, offset, offset + length)
+            task['failures'] = 0
+            task['progress']['moved'] = True
+            self.__adapt_part_size(task, length, fetchtime)
+
+        # Drops a cancelled or failed task once none of its parts are in
+        # flight. Files given up on are left as they are for a later update.
+        def task_drop(task):
+            journal.canceled(task)
+            task['file'].close()
+            if task['slot'] != None: table.free(task['slot'])
+
+            path = task['listing']['info']['path']
+
+            if task['canceled']:
+                if task.get('created', True):
+                    pathlib.Path(task['saveto']).unlink(missing_ok=True)
+
+                events.send({'status': 'filecanceled', 'path': path})
+
+            else: events.send({'status': 'fileerror', 'path': path})
+
+        def progress_start(task):
+            return {
+                'bytes': ranges_size(task['ranges']), 'time': time.monotonic(),
+                'rate': 0, 'avgrate': None, 'moved': True
+            }
+
+        # Writes the progress of every task that moved since the last report,
+        # or that has yet to report it stopped, to the table. Tasks without a
+        # slot have theirs sent in one message. The rate is over the time
+        # since the last report and the smoothed rate and the seconds left go
+        # by all reports. Tasks being checked report once they are done.
+        def progress_report():
+            now = time.monotonic()
+            report = []
 
             for task in tasks:
-                if not task['done']: tasksleft.append(task)
+                progress = task['progress']
+                if not progress['moved'] and progress['rate'] == 0: continue
+                if task['verifying'] or task['canceled']: continue
+
+                bytesdone = ranges_size(task['ranges'])
+                elapsed = max(now - progress['time'], 0.001)
+                rate = (bytesdone - progress['bytes']) / elapsed
 
-                else: pipe.send({
-                    'status': 'filedone',
+                if progress['avgrate'] == None: avgrate = rate
+                else: avgrate = 0.7 * progress['avgrate'] + 0.3 * rate
+
+                if avgrate > 0: eta = (task['size'] - bytesdone) / avgrate
+                else: eta = None
+
+                progress.update({
+                    'bytes': bytesdone, 'time': now, 'rate': rate,
+                    'avgrate': avgrate, 'moved': False
+                })
+
+                if task['slot'] != None:
+                    table.write(
+                        task['slot'], task['id'], bytesdone, task['size'],
+                        rate, avgrate, eta
+                    )
+
+                    continue
+
+                report.append({
+                    'path': task['listing']['info']['path'],
+                    'bytesdone': bytesdone, 'size': task['size'],
+                    'rate': rate, 'avgrate': avgrate, 'eta': eta
+                })
+
+            if len(report) > 0:
+                events.send({'status': 'progress', 'tasks': report})
+
+            return now
+
+        def task_pause(task, paused):
+            if task['done'] or task['paused'] == paused: return
+
+            task['paused'] = paused
+            if not paused: task['progress'] = progress_start(task)
+            journal.update(task, paused=paused)
+
+            events.send({
+                'status': 'filepaused' if paused else 'fileresumed',
+                'path': task['listing']['info']['path'],
+                'bytesdone': ranges_size(task['ranges']),
+                'size': task['size']
+            })
+
+        def targets(data):
+            for task in tasks:
+                if task['canceled']: continue
+                elif 'target' not in data: yield task
+                elif task['listing']['info']['path'] == data['target']:
+                    yield task
+
+        for task in journal.load():
+            try: file = open(task['saveto'], 'r+b')
+            except OSError: file = None
+
+            if file == None:
+                events.send({
+                    'status': 'fileerror',
                     'path': task['listing']['info']['path']
                 })
 
-                index += 1
+                continue
+
+            # Only what is still on disk counts as done
+            try: ondisk = os.fstat(file.fileno()).st_size
+            except OSError: ondisk = 0
+
+            task['ranges'] = [
+                (first, min(last, ondisk))
+                for first, last in task['ranges'] if first < ondisk
+            ]
+
+            task['file'] = file
+            task['done'] = False
+            task_ready(task)
+            task_verify(task, list(task['ranges']))
+
+            events.send({
+                'status': 'fileverifying',
+                'name': task['listing']['info']['name'],
+                'path': task['listing']['info']['path'],
+                'bytesdone': ranges_size(task['ranges']),
+                'size': task['size'], 'slot': task['slot'], 'id': task['id']
+            })
+
+        while True:
+            # Until a command arrives, a thread finishes, a failed part may
+            # be tried again, progress is due to be synced or reported
+            now = time.monotonic()
+            timeout = retrywait
+            due = journal.due()
+            if due != None and (timeout == None or due < timeout): timeout = due
+
+            reportable = [
+                task for task in tasks
+                if not (task['verifying'] or task['canceled']) and (
+                    task['progress']['moved'] or task['progress']['rate'] != 0
+                )
+            ]
+
+            if len(reportable) > 0:
+                due = max(lastreport + progress_event_interval - now, 0)
+                if timeout == None or due < timeout: timeout = due
+
+            mp.connection.wait([commands, wakeup], timeout)
+            while wakeup.poll(): wakeup.recv_bytes()
+
+            for future in [future for future in starting if future.done()]:
+                task_started(future)
+
+            for future in [future for future in verifying if future.done()]:
+                task_verified(future)
+
+            for future in [future for future in fetching if future.done()]:
+                part_fetched(future)
+
+            data = None
+
+            # A parent gone without a word is taken as a stop
+            try:
+                if commands.poll(): data = commands.recv()
+            except (EOFError, OSError): data = {'command': 'stop'}
+
+            if type(data) == type({}) and 'command' in data:
+                if data['command'] == 'stop': break
+
+                elif data['command'] == 'poolstats':
+                    stats = self.pool_stats()
+                    stats['status'] = 'poolstats'
+                    events.send(stats)
+
+                elif data['command'] == 'file':
+                    # A file already being downloaded is not started twice.
+                    # Asking for it again resumes it if it was paused.
+                    started = [
+                        task['listing']['info']['path'] for task in tasks
+                    ]
+
+                    started += [
+                        command['path'] for command in starting.values()
+                    ]
+
+                    for task in targets({'target': data['path']}):
+                        task_pause(task, False)
+
+                    if data['path'] not in started:
+                        future = starters.submit(self.__start_task, data)
+                        watched(future)
+                        starting[future] = data
+
+                elif data['command'] == 'pause' or data['command'] == 'resume':
+                    paused = data['command'] == 'pause'
+                    for task in targets(data): task_pause(task, paused)
+
+                elif data['command'] == 'priority' and 'priority' in data:
+                    for task in targets(data):
+                        task['priority'] = data['priority']
+                        journal.update(task, priority=data['priority'])
+
+                elif data['command'] == 'front' and 'target' in data:
+                    first = min([task['order'] for task in tasks], default=0)
+                    for task in targets(data): task['order'] = first - 1
+
+                # Parts in flight still write to the file, so it is only
+                # dropped once they are back
+                elif data['command'] == 'cancel' and 'target' in data:
+                    for task in targets(data):
+                        if not task['done']: task['canceled'] = True
+
+            retrywait = self.__schedule(tasks, fetching, submit_part)
+            tasksleft = []
+
+            for task in tasks:
+                complete = ranges_size(task['ranges']) == task['size']
+
+                idle = task['inflight'] == 0 and not task['verifying']
+
+                if (task['failed'] or task['canceled']) and idle:
+                    task_drop(task)
+                    continue
+
+                if complete and idle:
+                    journal.finished(task)
+                    task['file'].close()
+                    if task['slot'] != None: table.free(task['slot'])
+                    task['done'] = True
+
+                    events.send({
+                        'status': 'filedone',
+                        'path': task['listing']['info']['path'],
+                        'size': task['size']
+                    })
+
+                    continue
+
+                tasksleft.append(task)
 
             tasks = tasksleft
 
+            if time.monotonic() - lastreport >= progress_event_interval:
+                lastreport = progress_report()
+            journal.sync(tasks)
+
+        # Keep the parts that are still arriving
+        futures.wait(fetching)
+        for future in list(fetching): part_fetched(future)
+        workers.shutdown()
+
+        # Resumed tasks not yet checked are checked again next time
+        stopping.set()
+        futures.wait(verifying)
+        verifiers.shutdown(cancel_futures=True)
+        checkers.shutdown()
+
         for task in tasks:
-            if not task['done']: task['file'].close()
-            del task['file']
-            del task['lasttime']
+            if task['failed'] or task['canceled']: task_drop(task)
+
+        tasks = [
+            task for task in tasks
+            if not (task['failed'] or task['canceled'])
+        ]
+
+        # Tasks still being started are dropped with their empty files
+        futures.wait(starting)
+
+        for future in starting:
+            if future.exception() != None: continue
+            task = future.result()
+
+            if task != None:
+                task['file'].close()
+
+                if task['created']:
+                    pathlib.Path(task['saveto']).unlink(missing_ok=True)
 
-        if len(tasks) > 0:
-            try: progress = shelve.open(self.__progress_storage)
-            except: progress = None
+        starters.shutdown()
 
-            if progress != None:
-                progress['getfile_tasks'] = tasks
-                progress.close()
+        journal.close(tasks)
+        for task in tasks: task['file'].close()
 
-        else: pathlib.Path(self.__progress_storage).unlink(missing_ok=True)
+        waker.close()
+        wakeup.close()
 
 class PyFSClient(ClientLogic):
-    def __init__(self, addr, progress_storage):
+    # Events go to callback instead of being printed, as with
+    # getfile_monitor_silence, including those sent as the process starts.
+    def __init__(self, addr, progress_storage, callback=None):
         ClientLogic.__init__(self, addr)
 
         if not self.server_ok(): return
 
         dm = DownloadManager(addr, progress_storage)
 
-        self.__getfile_pipe, childpipe = mp.Pipe()
+        # Commands and events go over pipes of their own so the monitor can
+        # wait for events while commands are sent
+        commands, self.__getfile_pipe = mp.Pipe(duplex=False)
+        self.__getfile_events, events = mp.Pipe(duplex=False)
         self.__getfile_pipe_lock = threading.Lock()
 
-        process = mp.Process(target=dm.getfile_proc_fun, args=(childpipe,))
+        # Progress is read from shared memory instead of arriving as events
+        self.__getfile_table = ProgressTable()
+        self.__getfile_slots = {} # Downloads there as path: (slot, id)
+        self.__getfile_monitor_callback = callback
+
+        process = mp.Process(
+            target=dm.getfile_proc_fun,
+            args=(commands, events, self.__getfile_table)
+        )
+
         process.start()
         self.__getfile_process = process
 
+        # The events pipe ends once the process has exited
+        commands.close()
+        events.close()
+
+        self.__getfolder_tasks = {}
+        self.__getfolder_files = {} # Files of folders as path: event queue
+        self.__getfile_active = set() # Downloads asked for and not yet ended
+        self.__getfolder_lock = threading.Lock()
+
         thread = threading.Thread(target=self.__getfile_monitor)
         self.__getfile_monitor_thread_stop = False
         self.__getfile_monitor_thread = thread
         self.__getfile_monitor_thread.start()
 
+    # Sleeps until the download process has something to say and stops when
+    # the process is gone. Events after cleanup has begun are dropped.
     def __getfile_monitor(self):
-        self.__getfile_monitor_callback = None
-        self.__getfile_monitor_thread_stop = False
+        while True:
+            try: data = self.__getfile_events.recv()
+            except (EOFError, OSError): break
 
-        while not self.__getfile_monitor_thread_stop:
-            try:
-                self.__getfile_pipe_lock.acquire()
+            if not self.__getfile_monitor_thread_stop:
+                self.__getfile_event(data)
+
+        self.__getfile_events.close()
+
+    def __getfile_event(self, data):
+        if type(data) != type({}): return
 
-                if self.__getfile_pipe.poll():
-                    data = self.__getfile_pipe.recv()
-                else: data = None
+        # Progress of all downloads arrives together and goes out for each
+        if data.get('status') == 'progress':
+            for progress in data['tasks']:
+                progress['status'] = 'fileprogress'
+                self.__getfile_event(progress)
 
-                self.__getfile_pipe_lock.release()
+            return
 
-                if data == None: time.sleep(0.1) # Go idle
-                else: time.sleep(0.02)
+        status = data.get('status')
 
-            except:
-                self.__getfile_pipe_lock.release()
-                break
+        if data.get('slot') != None:
+            self.__getfile_slots[data['path']] = (data['slot'], data['id'])
 
-            if data != None and type(data) == type({}):
-                callback = self.__getfile_monitor_callback
+        elif status in ('filedone', 'fileerror', 'filecanceled'):
+            self.__getfile_slots.pop(data['path'], None)
 
-                if callback != None: callback(data)
+        # Files of folders report to their folder's thread up to their last
+        # event, which may come after the thread is gone if it was cancelled
+        if 'path' in data:
+            with self.__getfolder_lock:
+                if status in ('filedone', 'fileerror', 'filecanceled'):
+                    self.__getfile_active.discard(data['path'])
+                    events = self.__getfolder_files.pop(data['path'], None)
 
                 else:
-                    if 'status' in data:
-                        if data['status'] == 'filestarted':
-                            print('Started downloading', data['path'])
+                    # Left over from before and resumed from the journal
+                    if status == 'fileverifying':
+                        self.__getfile_active.add(data['path'])
+
+                    events = self.__getfolder_files.get(data['path'])
+
+            if events != None:
+                events.put(data)
+                return
+
+        callback = self.__getfile_monitor_callback
+
+        if callback != None:
+            callback(data)
+            return
+
+        if 'status' not in data: return
+
+        if data['status'] == 'filestarted':
+            print('Started downloading', data['path'])
+
+        elif data['status'] == 'fileerror':
+            print('Failed to download', data['path'])
+
+        elif data['status'] == 'filedone':
+            print('Finished downloading', data['path'])
+
+        elif data.get('unverified'):
+            print('Could not verify', data['path'], '- downloading it again')
+
+        elif data['status'] == 'filepaused':
+            print('Paused downloading', data['path'])
 
-                        elif data['status'] == 'fileerror':
-                            print('Failed to download', data['path'])
+        elif data['status'] == 'fileresumed':
+            print('Resumed downloading', data['path'])
 
-                        elif data['status'] == 'filedone':
-                            print('Finished downloading', data['path'])
+        elif data['status'] == 'fileverifying':
+            print('Verifying', data['path'])
 
-                        elif data['status'] == 'filepaused':
-                            print('Paused downloading', data['path'])
+        elif data['status'] == 'fileprogress':
+            print('Downloading', data['path'])
 
-                        elif data['status'] == 'fileresumed':
-                            print('Resumed downloading', data['path'])
+            if data['size'] == 0: percent = 100
+            else: percent = math.floor(100 * data['bytesdone'] / data['size'])
 
-                        elif data['status'] == 'fileprogress':
-                            print('Downloading', data['path'])
+            rate = data['avgrate']
+            rateunit = 'B'
 
-                            numerator = data['partdone'] + 1
-                            denominator = data['partmax'] + 1
-                            percent = math.floor(100 * numerator/ denominator)
+            if rate >= 1024:
+                rate /= 1024
+                rateunit = 'KB'
 
-                            rate = data['partsize'] / data['timetaken']
-                            rateunit = 'B'
+            if rate >= 1024:
+                rate /= 1024
+                rateunit = 'MB'
 
-                            if rate >= 1024:
-                                rate /= 1024
-                                rateunit = 'KB'
+            if rate >= 1024:
+                rate /= 1024
+                rateunit = 'GB'
 
-                            if rate >= 1024:
-                                rate /= 1024
-                                rateunit = 'MB'
+            rate = str(round(rate, 2)) + rateunit +'/s'
 
-                            if rate >= 1024:
-                                rate /= 1024
-                                rateunit = 'GB'
+            if data['eta'] == None: print(str(percent) + '% complete at', rate)
 
-                            rate = str(round(rate, 2)) + rateunit +'/s'
+            else:
+                print(
+                    str(percent) + '% complete at', rate + ',',
+                    round(data['eta']), 'seconds left'
+                )
 
-                            print(str(percent) + '% complete at', rate)
+        elif data['status'] == 'folderprogress':
+            print('Downloading', data['path'], data['bytesdone'], 'bytes')
+
+        elif data['status'] == 'filecanceled':
+            print('Cancelled downloading', data['path'])
+
+        elif data['status'] == 'poolstats':
+            print('Download connections:', data['connections'], 'opened,',
+                data['reused'], 'reused for', data['requests'], 'requests')
 
     def getfile_monitor_silence(self, callback):
         self.__getfile_monitor_callback = callback
 
-    def __getfile_monitor_stop(self):
-        self.__getfile_monitor_thread_stop = True
-        self.__getfile_monitor_thread.join()
+    # Returns the latest progress of a download, as in 'fileprogress' events,
+    # or None if it is not running or its progress arrives as events instead
+    def getfile_progress(self, path):
+        slot = self.__getfile_slots.get(path)
+        if slot == None: return None
 
-    def getfile(self, path, callback=None, saveto=None):
-        self.__getfile_pipe_lock.acquire()
+        progress = self.__getfile_table.read(*slot)
+        if progress != None: progress['path'] = path
+
+        return progress
+
+    # With update, a file already at saveto is brought up to date by fetching
+    # only the parts that differ from the server's. info, the file's name,
+    # path, size and modified time as listed, saves asking the server again.
+    def getfile(
+        self, path, callback=None, saveto=None, priority=None, update=False,
+        info=None
+    ):
         command = {'command': 'file', 'path': path}
 
         if saveto != None: command['saveto'] = saveto
+        if priority != None: command['priority'] = priority
+        if update: command['update'] = True
+        if info != None: command['info'] = info
+
+        self.__getfile_send(command)
+
+    # Sends a file command. With folder, an event queue, the download reports
+    # there instead, unless the file is already being downloaded on its own
+    # or for another folder, when False is returned.
+    def __getfile_send(self, command, folder=None):
+        path = command['path']
+
+        with self.__getfolder_lock:
+            if folder != None:
+                if path in self.__getfile_active: return False
+                self.__getfolder_files[path] = folder
+
+            self.__getfile_active.add(path)
+
+            self.__getfile_pipe_lock.acquire()
+            self.__getfile_pipe.send(command)
+            self.__getfile_pipe_lock.release()
+
+        return True
+
+    # Directories are walked on a thread of their own, which hands their files
+    # to the download process while the listing is still arriving. They report
+    # through the same events as files, with their progress in
+    # 'folderprogress' events as their total size is not known until the end.
+    def getfolder(self, path, saveto):
+        if path in self.__getfolder_tasks: return
+
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self.__getfolder_thread, args=(path, saveto, stop)
+        )
+
+        self.__getfolder_tasks[path] = (thread, stop)
+        thread.start()
+
+    def __getfolder_thread(self, path, saveto, stop):
+        name = pathlib.PurePosixPath(path).name
+        self.__getfile_event({'status': 'filestarted', 'path': path,
+            'name': name, 'folder': True})
+
+        events = queue.Queue()
+        inflight = {} # Files being downloaded as path: bytes done
+        counts = {'files': 0, 'filesdone': 0, 'failed': 0, 'bytesdone': 0}
+        last = {'time': time.monotonic(), 'bytes': 0}
+
+        def handle(event):
+            file = event['path']
+            if file not in inflight: return
+
+            if event['status'] in ('fileprogress', 'fileresumed'):
+                counts['bytesdone'] += event['bytesdone'] - inflight[file]
+                inflight[file] = event['bytesdone']
+                return
+
+            if event['status'] == 'filedone':
+                counts['bytesdone'] += event['size'] - inflight[file]
+                counts['filesdone'] += 1
+
+            elif event['status'] in ('fileerror', 'filecanceled'):
+                counts['failed'] += 1
+
+            else: return
+
+            del inflight[file]
+
+        def handle_events(wait):
+            try:
+                handle(events.get(timeout=wait))
+
+                while True: handle(events.get_nowait())
 
-        self.__getfile_pipe.send(command)
+            except queue.Empty: pass
+
+            now = time.monotonic()
+            if now - last['time'] < folder_progress_interval: return
+
+            for file in inflight:
+                progress = self.getfile_progress(file)
+                if progress == None: continue
+
+                counts['bytesdone'] += progress['bytesdone'] - inflight[file]
+                inflight[file] = progress['bytesdone']
+
+            self.__getfile_event({
+                'status': 'folderprogress', 'path': path,
+                'bytesdone': counts['bytesdone'], 'files': counts['files'],
+                'filesdone': counts['filesdone'],
+                'partsize': counts['bytesdone'] - last['bytes'],
+                'timetaken': now - last['time']
+            })
+
+            last['time'], last['bytes'] = now, counts['bytesdone']
+
+        tree = self.list_tree(path)
+        header = next(tree, None)
+        listed = header != None and header['status'] == 'ok'
+
+        if listed and header['type'] == 'dir':
+            base = header['info']['path']
+            root = pathlib.Path(saveto) / name
+
+            sample = []
+            if not root.exists():
+                sample = list(itertools.islice(tree, folder_archive_sample))
+
+            entries = itertools.chain(sample, tree)
+
+            if self.__getfolder_archived(sample):
+                tree.close()
+                entries = []
+
+                if not self.__getfolder_archive(path, saveto, stop):
+                    counts['failed'] += 1
+
+                # The folder was not there before, so none of it is kept
+                if stop.is_set(): shutil.rmtree(root, ignore_errors=True)
+
+            for entry in entries:
+                if stop.is_set(): break
+
+                # The rest of the tree never arrived
+                if entry.get('status') == 'error':
+                    counts['failed'] += 1
+                    break
+
+                dest = local_path(root, entry['path'])
+                if dest == None: continue
+
+                try:
+                    if entry['type'] == 'dir':
+                        dest.mkdir(parents=True, exist_ok=True)
+                        continue
+
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+
+                except OSError:
+                    counts['failed'] += 1
+                    continue
+
+                full = len(inflight) >= folder_files_in_flight
+
+                while full and not stop.is_set():
+                    handle_events(0.1)
+                    full = len(inflight) >= folder_files_in_flight
+
+                if stop.is_set(): break
+
+                file = base + entry['path']
+                counts['files'] += 1
+
+                command = {
+                    'command': 'file', 'path': file, 'saveto': str(dest),
+                    'update': True
+                }
+
+                # The listing is passed on so the file is not listed again
+                if 'size' in entry:
+                    command['info'] = {
+                        'name': pathlib.PurePosixPath(file).name,
+                        'path': file, 'size': entry['size'],
+                        'modified': entry.get('modified')
+                    }
+
+                # A file downloaded on its own keeps reporting there. It is
+                # not taken over as it may be saved somewhere else.
+                if not self.__getfile_send(command, events):
+                    counts['failed'] += 1
+                    continue
+
+                inflight[file] = 0
+                handle_events(0)
+
+            while len(inflight) > 0 and not stop.is_set(): handle_events(0.1)
+
+        else: counts['failed'] += 1
+
+        # Files of a cancelled folder are cancelled with it
+        for file in inflight: self.getfile_cancel(file)
+
+        if stop.is_set(): status = 'filecanceled'
+        elif counts['failed'] == 0: status = 'filedone'
+        else: status = 'fileerror'
+
+        del self.__getfolder_tasks[path]
+        self.__getfile_event({'status': status, 'path': path})
+
+    # Whether a folder listed as sample, all of it if it fits, is better
+    # fetched as an archive
+    def __getfolder_archived(self, sample):
+        files = [entry for entry in sample if entry.get('type') == 'file']
+        if len(files) == 0: return False
+
+        for entry in sample:
+            if entry.get('status') == 'error': return False
+
+        size = sum([entry.get('size', 0) for entry in files])
+        return size <= len(files) * folder_archive_file_size
+
+    # Unpacks a folder from its archive, with progress in 'folderprogress'
+    # events as the total size of the archive is not known
+    def __getfolder_archive(self, path, saveto, stop):
+        last = {'time': time.monotonic(), 'bytes': 0}
+
+        def progress(bytesdone):
+            if stop.is_set(): return False
+
+            now = time.monotonic()
+            if now - last['time'] < folder_progress_interval: return True
+
+            self.__getfile_event({
+                'status': 'folderprogress', 'path': path,
+                'bytesdone': bytesdone,
+                'partsize': bytesdone - last['bytes'],
+                'timetaken': now - last['time']
+            })
+
+            last['time'], last['bytes'] = now, bytesdone
+            return True
+
+        return self.getarchive(path, saveto, progress)
+
+    # The download process answers with a 'poolstats' event
+    def getfile_pool_stats(self):
+        self.__getfile_pipe_lock.acquire()
+        self.__getfile_pipe.send({'command': 'poolstats'})
+        self.__getfile_pipe_lock.release()
+
+    # Higher priority downloads get free download slots first
+    def getfile_priority(self, target, priority):
+        self.__getfile_pipe_lock.acquire()
+        self.__getfile_pipe.send({
+            'command': 'priority', 'target': target, 'priority': priority
+        })
+        self.__getfile_pipe_lock.release()
+
+    # Puts a download ahead of the others of the same priority
+    def getfile_front(self, target):
+        self.__getfile_pipe_lock.acquire()
+        self.__getfile_pipe.send({'command': 'front', 'target': target})
         self.__getfile_pipe_lock.release()
 
     def getfile_pause(self, target=None):
@@ -404,27 +2001,38 @@ class PyFSClient(ClientLogic):
         self.__getfile_pipe_lock.release()
 
     def getfile_cancel(self, target):
+        if target in self.__getfolder_tasks:
+            self.__getfolder_tasks[target][1].set()
+            return
+
         self.__getfile_pipe_lock.acquire()
         self.__getfile_pipe.send({'command': 'cancel', 'target': target})
         self.__getfile_pipe_lock.release()
 
     def cleanup(self):
+        for thread, stop in list(self.__getfolder_tasks.values()):
+            stop.set()
+            thread.join()
+
+        self.__getfile_monitor_thread_stop = True
+
         if self.__getfile_process.is_alive():
             self.__getfile_pipe_lock.acquire()
             self.__getfile_pipe.send({'command': 'stop'})
             self.__getfile_pipe_lock.release()
 
-        self.__getfile_monitor_stop()
-
-        for unused in range(6):
-            if self.__getfile_process.is_alive(): time.sleep(0.5)
-            else: break
+        self.__getfile_process.join(3)
 
         if self.__getfile_process.is_alive():
             self.__getfile_process.terminate()
-
-            for unused in range(4):
-                if self.__getfile_process.is_alive(): time.sleep(0.5)
-                else: break
+            self.__getfile_process.join(2)
 
             if self.__getfile_process.is_alive(): self.__getfile_process.kill()
+
+        self.__getfile_process.join()
+        self.__getfile_monitor_thread.join()
+        self.__getfile_pipe.close()
+
+        self.__getfile_slots = {}
+        self.__getfile_table.close()
+        self.__getfile_table.unlink()
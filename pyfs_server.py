@@ -1,9 +1,23 @@
 #!/usr/bin/env python3
 
 import io
+import os
+import re
+import sys
+import json
+import heapq
+import itertools
+import stat
+import fnmatch
+import tarfile
 import time
+import math
 import pathlib
 import hashlib
+import shelve
+import threading
+import functools
+import collections
 
 import bottle
 import cherrypy
@@ -21,14 +35,229 @@ file_chunk_size_default = 1024 * 1024
 file_chunk_size_min = 512
 file_chunk_size_max = 32 * 1024 * 1024
 
+# Size of the blocks file parts are streamed in when the WSGI server cannot
+# send them straight from the file (sendfile) itself.
+file_stream_block_size = 64 * 1024
+
+# Where part digests are kept between runs and how often they are written out.
+hash_manifest_storage = 'hashes.shelf'
+hash_manifest_save_interval = 30
+
+# Manifests kept in memory, the least recently used going first. Stored ones
+# of files that changed or are gone, or that were not used for this many
+# seconds, are dropped when the storage is opened.
+hash_manifest_memory_entries = 128
+hash_manifest_keep_time = 30 * 24 * 3600
+
+# Largest number of entries a single page of a directory listing may hold.
+list_page_size_max = 10000
+
+# Memory in bytes kept for the names of recently listed directories. Set to 0
+# to scan directories on every request.
+list_cache_size = 32 * 1024 * 1024
+
+# Requests for more byte ranges than this get the whole file instead.
+file_range_count_max = 64
+
 # -- End of user configurable options --
 
+# Response header carrying the SHA-256 digest of the part sent by /get.
+file_hash_header = 'X-PyFS-SHA256'
+
 app = bottle.Bottle()
 
 def time_convert(seconds):
     moment = time.localtime(seconds)
     return time.strftime("%j%Y%H%M%S%z", moment)
 
+# A read-only window of a file. Bottle hands objects with read() to the WSGI
+# server's wsgi.file_wrapper when there is one (servers use sendfile with it)
+# or streams them in small blocks otherwise. The handle is closed by the WSGI
+# server once the response is done.
+class FilePart:
+    def __init__(self, path, offset, length):
+        self.__handle = open(path, 'rb')
+        self.__handle.seek(offset, io.SEEK_SET)
+        self.__left = length
+
+    def fileno(self): return self.__handle.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.__left: size = self.__left
+        if size > file_stream_block_size: size = file_stream_block_size
+
+        data = self.__handle.read(size)
+        self.__left -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read()
+            if len(data) == 0: break
+            yield data
+
+    def close(self): self.__handle.close()
+
+def hash_file_part(path, offset, length):
+    data = FilePart(path, offset, length)
+    hash = hashlib.sha256()
+
+    try:
+        for block in data: hash.update(block)
+    finally: data.close()
+
+    return hash.hexdigest()
+
+# Digests of every part of a file for a given chunk size, kept across restarts.
+# Entries are thrown away when the size, modification time or inode of the
+# file no longer match the ones they were made for.
+class HashManifests:
+    def __init__(self, path):
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__shelf = None
+        self.__entries = collections.OrderedDict()
+        self.__dirty = set()
+        self.__lastsaved = time.monotonic()
+
+    def __entry(self, path, info, chunksize):
+        key = path + '\n' + str(chunksize)
+        stamp = (info.st_size, info.st_mtime_ns, info.st_ino)
+
+        if key in self.__entries:
+            entry = self.__entries[key]
+            self.__entries.move_to_end(key)
+
+        else:
+            if self.__shelf == None: self.__open()
+
+            try: entry = self.__shelf.get(key)
+            except: entry = None
+
+        # Digests are kept by part number as only some may ever be asked for
+        if entry == None or entry['stamp'] != stamp:
+            entry = {'stamp': stamp, 'sha256': {}, 'used': 0}
+
+        # When it was last used reaches the storage at most once a day
+        now = time.time()
+
+        if now - entry.get('used', 0) > 24 * 3600:
+            entry['used'] = now
+            self.__dirty.add(key)
+
+        self.__entries[key] = entry
+
+        # Changes to those pushed out of memory are stored first
+        while len(self.__entries) > hash_manifest_memory_entries:
+            evicted, old = self.__entries.popitem(last=False)
+
+            if evicted in self.__dirty:
+                self.__store(evicted, old)
+                self.__dirty.discard(evicted)
+
+        return key, entry
+
+    def __open(self):
+        try: self.__shelf = shelve.open(self.__path)
+
+        except:
+            self.__shelf = {}
+            return
+
+        now = time.time()
+
+        try: keys = list(self.__shelf.keys())
+        except: keys = []
+
+        for key in keys:
+            try:
+                info = os.stat(key.rsplit('\n', 1)[0])
+                stamp = (info.st_size, info.st_mtime_ns, info.st_ino)
+
+                entry = self.__shelf[key]
+                unused = now - entry.get('used', 0) > hash_manifest_keep_time
+                keep = entry['stamp'] == stamp and not unused
+
+            except: keep = False
+
+            if not keep:
+                try: del self.__shelf[key]
+                except: pass
+
+    def __store(self, key, entry):
+        try: self.__shelf[key] = entry
+        except: pass
+
+    def digests(self, path, info, chunksize, first=0, count=None):
+        parts = math.ceil(info.st_size / chunksize)
+
+        if count == None: count = parts - first
+        count = max(min(count, parts - first), 0)
+
+        with self.__lock:
+            key, entry = self.__entry(path, info, chunksize)
+            digests = entry['sha256']
+
+            wanted = []
+
+            for part in range(first, first + count):
+                if part in digests: wanted.append(digests[part])
+                else: wanted.append(None)
+
+        missing = [index for index, hash in enumerate(wanted) if hash == None]
+
+        for index in missing:
+            offset = (first + index) * chunksize
+            length = min(chunksize, info.st_size - offset)
+            wanted[index] = hash_file_part(path, offset, length)
+
+        with self.__lock:
+            unused, entry = self.__entry(path, info, chunksize)
+
+            if entry['sha256'] is digests and len(missing) > 0:
+                for index in missing: digests[first + index] = wanted[index]
+                self.__dirty.add(key)
+
+            if time.monotonic() - self.__lastsaved > hash_manifest_save_interval:
+                self.__save()
+
+        return wanted
+
+    def digest(self, path, info, chunksize, part):
+        return self.digests(path, info, chunksize, part, 1)[0]
+
+    def __save(self):
+        if self.__shelf != None:
+            for key in self.__dirty: self.__store(key, self.__entries[key])
+            if hasattr(self.__shelf, 'sync'): self.__shelf.sync()
+
+        self.__dirty = set()
+        self.__lastsaved = time.monotonic()
+
+    def save(self):
+        with self.__lock: self.__save()
+
+    def close(self):
+        with self.__lock:
+            self.__save()
+
+            if hasattr(self.__shelf, 'close'): self.__shelf.close()
+
+            self.__shelf = None
+
+manifests = HashManifests(hash_manifest_storage)
+
+def query_chunk_size():
+    try: chunk = int(bottle.request.query.chunksize)
+    except: return file_chunk_size_default
+
+    if chunk < file_chunk_size_min:
+        return {'status': 'error', 'reason': 'chunk size too small'}
+    elif chunk > file_chunk_size_max:
+        return {'status': 'error', 'reason': 'chunk size too large'}
+
+    return chunk
+
 @app.route('/')
 def welcome():
     return {
@@ -37,7 +266,258 @@ def welcome():
        'chunkdefault': file_chunk_size_default, 'servername': server_name
     }
 
+# Parameters format for directories is [offset=<int>][&limit=<int>]
+# [&after=<cursor>][&sort=name|none][&format=json|ndjson]
+def query_listing():
+    query = bottle.request.query
+
+    if query.format in ('', 'json'): format = 'json'
+    elif query.format == 'ndjson': format = 'ndjson'
+    else: return {'status': 'error', 'reason': 'unknown format'}
+
+    # Streamed listings go out in the order entries are found by default
+    if query.sort == '':
+        if format == 'ndjson': sort = False
+        else: sort = True
+
+    elif query.sort in ('name', 'none'): sort = query.sort == 'name'
+    else: return {'status': 'error', 'reason': 'unknown sort order'}
+
+    try:
+        offset = int(query.offset or 0)
+        if query.limit != '': limit = int(query.limit)
+        else: limit = None
+
+    except: return {'status': 'error', 'reason': 'bad page range'}
+
+    if offset < 0 or (limit != None and limit < 0):
+        return {'status': 'error', 'reason': 'negative page range'}
+
+    if limit != None and limit > list_page_size_max:
+        return {'status': 'error', 'reason': 'page size too large'}
+
+    if query.after != '' and not sort:
+        return {'status': 'error', 'reason': 'cursor needs sorting'}
+
+    if query.after != '': after = query.after
+    else: after = None
+
+    return {
+        'format': format, 'sort': sort, 'offset': offset, 'limit': limit,
+        'after': after
+    }
+
+# Names and types of the entries of recently listed directories. A directory
+# gets a new modification time when entries are added, removed or renamed in
+# it so cached entries are only used while the time and inode still match.
+# File details are not cached as they change without the directory changing.
+class ListingCache:
+    def __init__(self, budget):
+        self.__budget = budget
+        self.__used = 0
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+
+    def __put(self, key, stamp, entries, size):
+        with self.__lock:
+            if key in self.__entries: self.__used -= self.__entries[key][2]
+
+            self.__entries[key] = (stamp, entries, size)
+            self.__used += size
+
+            while self.__used > self.__budget:
+                unused, evicted = self.__entries.popitem(last=False)
+                self.__used -= evicted[2]
+
+    def scan(self, target):
+        key = str(target)
+
+        try: info = os.stat(key)
+        except OSError: return
+
+        stamp = (info.st_mtime_ns, info.st_ino, info.st_dev)
+
+        with self.__lock:
+            cached = self.__entries.get(key)
+
+            if cached != None and cached[0] == stamp:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+
+            else:
+                cached = None
+                self.__misses += 1
+
+        if cached != None:
+            yield from cached[1]
+            return
+
+        entries = []
+        size = 0
+
+        with os.scandir(key) as children:
+            for child in children:
+                try: is_dir = child.is_dir()
+                except OSError: is_dir = False
+
+                if entries != None:
+                    entries.append((child.name, is_dir))
+                    size += sys.getsizeof(child.name) + 72
+
+                    # Too large to keep, hand out entries without caching
+                    if size > self.__budget: entries = None
+
+                yield child.name, is_dir
+
+        if entries != None: self.__put(key, stamp, entries, size)
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'hits': self.__hits, 'misses': self.__misses,
+                'entries': len(self.__entries), 'size': self.__used,
+                'budget': self.__budget
+            }
+
+listings = ListingCache(list_cache_size)
+
+def scan_dir(target): return listings.scan(target)
+
+# Sort key and page cursor of an entry. Directories come before files.
+def entry_key(name, is_dir):
+    if is_dir: return 'd:' + name
+    else: return 'f:' + name
+
+def entry_details(target, name):
+    try: info = os.stat(os.path.join(target, name))
+    except OSError: return None # Broken link, vanished file
+
+    return {
+        'size': info.st_size,
+        'created': time_convert(info.st_ctime),
+        'modified': time_convert(info.st_mtime)
+    }
+
+# Picks the entries of a page and returns them with the scan they came from.
+# Sorted pages only keep offset + limit entries in memory however large the
+# directory is.
+def dir_page(target, query, counts):
+    def scanned():
+        for name, is_dir in scan_dir(target):
+            counts['total'] += 1
+            after = query['after']
+
+            if after == None or entry_key(name, is_dir) > after:
+                counts['matched'] += 1
+                yield name, is_dir
+
+    offset, limit = query['offset'], query['limit']
+    entries = scanned()
+
+    if query['sort']:
+        key = lambda item: entry_key(*item)
+
+        if limit == None: page = sorted(entries, key=key)[offset:]
+
+        else:
+            page = heapq.nsmallest(offset + limit, entries, key=key)
+            page = page[offset:]
+
+    elif limit == None: page = itertools.islice(entries, offset, None)
+    else: page = itertools.islice(entries, offset, offset + limit)
+
+    return page, entries
+
+def list_dir(target, target_info, query):
+    counts = {'total': 0, 'matched': 0}
+    page, entries = dir_page(target, query, counts)
+
+    target_info['files'] = []
+    target_info['dirs'] = []
+    target_info['fileinfo'] = {}
+    last = None
+
+    for name, is_dir in page:
+        last = entry_key(name, is_dir)
+
+        if is_dir:
+            target_info['dirs'].append(name)
+            continue
+
+        target_info['files'].append(name)
+        details = entry_details(target, name)
+
+        if details != None: target_info['fileinfo'][name] = details
+
+    for unused in entries: pass # Count the rest of the directory
+
+    shown = query['offset'] + len(target_info['dirs'])
+    shown += len(target_info['files'])
+
+    target_info['offset'] = query['offset']
+    target_info['total'] = counts['total']
+    target_info['more'] = shown < counts['matched']
+
+    if target_info['more'] and query['sort']: target_info['next'] = last
+
+# One JSON document per line: the directory itself, then one per entry and
+# a closing line with the entry count.
+def stream_dir(target, target_info, query):
+    yield json.dumps({'status': 'ok', 'type': 'dir', 'info': target_info})
+    yield '\n'
+
+    count = 0
+    page, unused = dir_page(target, query, {'total': 0, 'matched': 0})
+
+    for name, is_dir in page:
+        line = {'name': name}
+
+        if is_dir: line['type'] = 'dir'
+
+        else:
+            line['type'] = 'file'
+            details = entry_details(target, name)
+            if details != None: line.update(details)
+
+        yield json.dumps(line) + '\n'
+        count += 1
+
+    yield json.dumps({'status': 'end', 'count': count}) + '\n'
+
+# Tags successful JSON responses with an ETag made from their content and
+# answers requests whose If-None-Match holds that tag with an empty 304.
+def conditional(callback):
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        result = callback(*args, **kwargs)
+
+        if type(result) != type({}) or result.get('status') != 'ok':
+            return result
+
+        body = json.dumps(result)
+        tag = '"' + hashlib.sha256(body.encode()).hexdigest()[:32] + '"'
+
+        bottle.response.set_header('ETag', tag)
+        bottle.response.set_header('Content-Type', 'application/json')
+
+        matches = bottle.request.get_header('If-None-Match', '').split(',')
+
+        if tag in [match.strip() for match in matches]:
+            bottle.response.status = 304
+            return ''
+
+        return body
+
+    return wrapper
+
+@app.route('/stats')
+def server_stats():
+    return {'status': 'ok', 'listcache': listings.stats()}
+
 @app.route('/list/')
+@conditional
 def list_shares():
     keys = []
     for key in shares.keys(): keys.append(key)
@@ -47,6 +527,7 @@ def list_shares():
 @app.route('/list/<sharename>')
 @app.route('/list/<sharename>/')
 @app.route('/list/<sharename>/<path:path>')
+@conditional
 def list_fs(sharename, path = ''):
     if sharename not in shares:
         return {'status': 'error', 'reason': 'not exist'}
@@ -81,20 +562,126 @@ def list_fs(sharename, path = ''):
             target_info['created'] = time_convert(info.st_ctime)
             target_info['modified'] = time_convert(info.st_mtime)
 
-            target_info['files'] = []
-            target_info['dirs'] = []
+            query = query_listing()
+            if 'status' in query: return query
 
-            for child in target.iterdir():
-                if child.is_dir(): target_info['dirs'].append(child.name)
-                else: target_info['files'].append(child.name)
+            if query['format'] == 'ndjson':
+                bottle.response.set_header(
+                    'Content-Type', 'application/x-ndjson')
+                return stream_dir(target, target_info, query)
 
-            target_info['files'].sort()
-            target_info['dirs'].sort()
+            list_dir(target, target_info, query)
 
         return {'status': 'ok', 'type': target_type, 'info': target_info}
 
     else: return {'status': 'error', 'reason': 'not exist'}
 
+# Patterns with a slash are matched against the path below the listed
+# directory, others against the name alone.
+def tree_match(patterns, name, path):
+    for pattern in patterns:
+        if '/' in pattern: subject = path
+        else: subject = name
+
+        if fnmatch.fnmatchcase(subject, pattern): return True
+
+    return False
+
+# Walks the tree depth first, one line per entry with its path below the
+# listed directory. Directories reached twice through links are skipped.
+def stream_tree(target, target_info, depth, include, exclude):
+    yield json.dumps({'status': 'ok', 'type': 'dir', 'info': target_info})
+    yield '\n'
+
+    count = 0
+    seen = set()
+    pending = [(str(target), '', 1)]
+
+    while len(pending) > 0:
+        dir, prefix, level = pending.pop()
+
+        try: info = os.stat(dir)
+        except OSError: continue
+
+        if (info.st_dev, info.st_ino) in seen: continue
+        seen.add((info.st_dev, info.st_ino))
+
+        subdirs = []
+
+        try: entries = sorted(scan_dir(dir), key=lambda item: entry_key(*item))
+        except OSError: continue
+
+        for name, is_dir in entries:
+            path = prefix + name
+            if tree_match(exclude, name, path): continue
+
+            line = {'path': path}
+
+            if is_dir:
+                line['type'] = 'dir'
+
+                if depth == None or level < depth:
+                    subdirs.append((os.path.join(dir, name), path + '/'))
+
+            else:
+                if len(include) > 0 and not tree_match(include, name, path):
+                    continue
+
+                line['type'] = 'file'
+                details = entry_details(dir, name)
+                if details != None: line.update(details)
+
+            yield json.dumps(line) + '\n'
+            count += 1
+
+        for subdir, subprefix in reversed(subdirs):
+            pending.append((subdir, subprefix, level + 1))
+
+    yield json.dumps({'status': 'end', 'count': count}) + '\n'
+
+# Parameters format is [depth=<int>][&include=<glob>...][&exclude=<glob>...]
+@app.get('/tree/<sharename>')
+@app.get('/tree/<sharename>/')
+@app.get('/tree/<sharename>/<path:path>')
+def list_tree(sharename, path=''):
+    if sharename not in shares:
+        return {'status': 'error', 'reason': 'not exist'}
+
+    share = pathlib.Path(shares[sharename]).resolve()
+    target = share / path
+
+    if not target.exists():
+        return {'status': 'error', 'reason': 'not exist'}
+
+    if not target.is_dir():
+        return {'status': 'error', 'reason': 'not dir'}
+
+    query = bottle.request.query
+
+    try:
+        if query.depth != '': depth = int(query.depth)
+        else: depth = None
+
+    except: return {'status': 'error', 'reason': 'bad depth'}
+
+    if depth != None and depth < 1:
+        return {'status': 'error', 'reason': 'depth too small'}
+
+    info = target.stat()
+    target_info = {
+        'name': target.name,
+        'path': sharename + '/' + str(target.relative_to(share) / 'a')[:-1],
+        'created': time_convert(info.st_ctime),
+        'modified': time_convert(info.st_mtime)
+    }
+
+    bottle.response.set_header('Content-Type', 'application/x-ndjson')
+
+    return stream_tree(
+        target, target_info, depth, query.getall('include'),
+        query.getall('exclude')
+    )
+
 # Parameters format is part=<int>[&chunksize=<int>]
 @app.get('/get/<sharename>/<path:path>')
 @app.get('/hash/<sharename>/<path:path>')
@@ -109,44 +696,304 @@ def read_file_part(sharename, path):
 
     if part < 0: return {'status': 'error', 'reason': 'negative part number'}
 
-    try:
-        chunk = int(bottle.request.query.chunksize)
-
-        if chunk < file_chunk_size_min:
-            return {'status': 'error', 'reason': 'chunk size too small'}
-        elif chunk > file_chunk_size_max:
-            return {'status': 'error', 'reason': 'chunk size too large'}
-        else:
-            chunk_size = chunk
-
-    except:
-        chunk_size = file_chunk_size_default
+    chunk_size = query_chunk_size()
+    if type(chunk_size) == type({}): return chunk_size
 
     if bottle.request.route.rule.startswith('/hash'): gethash = 1
     else: gethash = 0
 
     if target.exists():
         if target.is_file():
-            handle = open(str(target), "rb")
-            handle.seek(part * chunk_size, io.SEEK_SET)
-            data = handle.read(chunk_size)
+            info = target.stat()
+            size = info.st_size
+            offset = part * chunk_size
 
-            if len(data) == 0:
+            if offset >= size:
                 return {'status': 'error', 'reason': 'part number too high'}
 
+            length = min(chunk_size, size - offset)
+            hash = manifests.digest(str(target), info, chunk_size, part)
+
             if gethash != 1:
                 bottle.response.set_header(
                     'Content-Type', 'application/octet-stream')
-                return data
+                bottle.response.set_header('Content-Length', str(length))
+                bottle.response.set_header(file_hash_header, hash)
+                return FilePart(str(target), offset, length)
 
-            hash = hashlib.sha256()
-            hash.update(data)
-            return {'status': 'ok', 'sha256': hash.hexdigest()}
+            return {'status': 'ok', 'sha256': hash}
 
         else: return {'status': 'error', 'reason': 'not file'}
 
     else: return {'status': 'error', 'reason': 'not exist'}
 
+# Parameters format is [first=<int>][&count=<int>][&chunksize=<int>]
+@app.get('/hashes/<sharename>/<path:path>')
+def read_file_hashes(sharename, path):
+    if sharename not in shares:
+        return {'status': 'error', 'reason': 'not exist'}
+
+    target = pathlib.Path(shares[sharename]).resolve() / path
+
+    try:
+        first = int(bottle.request.query.first or 0)
+        count = bottle.request.query.count
+        if count != '': count = int(count)
+        else: count = None
+
+    except: return {'status': 'error', 'reason': 'bad part range'}
+
+    if first < 0 or (count != None and count < 0):
+        return {'status': 'error', 'reason': 'negative part number'}
+
+    chunk_size = query_chunk_size()
+    if type(chunk_size) == type({}): return chunk_size
+
+    if target.exists():
+        if target.is_file():
+            info = target.stat()
+            parts = math.ceil(info.st_size / chunk_size)
+
+            if first > parts:
+                return {'status': 'error', 'reason': 'part number too high'}
+
+            hashes = manifests.digests(
+                str(target), info, chunk_size, first, count
+            )
+
+            return {
+                'status': 'ok', 'chunksize': chunk_size, 'parts': parts,
+                'first': first, 'sha256': hashes
+            }
+
+        else: return {'status': 'error', 'reason': 'not file'}
+
+    else: return {'status': 'error', 'reason': 'not exist'}
+
+def multipart_ranges(path, ranges, size, boundary):
+    for start, end in ranges:
+        yield multipart_header(start, end, size, boundary)
+        data = FilePart(path, start, end - start)
+
+        try:
+            for block in data: yield block
+        finally: data.close()
+
+    yield ('\r\n--' + boundary + '--\r\n').encode()
+
+def multipart_header(start, end, size, boundary):
+    header = '\r\n--' + boundary + '\r\n'
+    header += 'Content-Type: application/octet-stream\r\n'
+    header += 'Content-Range: bytes %d-%d/%d\r\n\r\n' % (start, end - 1, size)
+    return header.encode()
+
+# Byte ranges of a Range header cut to the file, or None if the header does
+# not parse and is to be ignored. An empty list means no range is in the file.
+def parse_byte_ranges(header, size):
+    if not header.startswith('bytes='): return None
+
+    ranges = []
+    specs = [spec for spec in header[6:].split(',') if spec.strip() != '']
+
+    if len(specs) == 0: return None
+
+    for spec in specs:
+        match = re.fullmatch(r'\s*([0-9]*)\s*-\s*([0-9]*)\s*', spec)
+        if match == None: return None
+
+        first, last = match.groups()
+
+        if first == '': # The last bytes of the file
+            if last == '': return None
+
+            length = int(last)
+
+            if length > 0 and size > 0:
+                ranges.append((max(size - length, 0), size))
+
+            continue
+
+        start = int(first)
+
+        if last == '': end = size
+
+        else:
+            if int(last) < start: return None
+            end = min(int(last) + 1, size)
+
+        if start < size: ranges.append((start, end))
+
+    return ranges
+
+# Whole files with HTTP range requests (RFC 7233) for standard tools
+@app.get('/file/<sharename>/<path:path>')
+def read_file(sharename, path):
+    if sharename not in shares:
+        return {'status': 'error', 'reason': 'not exist'}
+
+    target = pathlib.Path(shares[sharename]).resolve() / path
+
+    if not target.exists():
+        return {'status': 'error', 'reason': 'not exist'}
+
+    if not target.is_file():
+        return {'status': 'error', 'reason': 'not file'}
+
+    info = target.stat()
+    size = info.st_size
+    tag = '"%x-%x-%x"' % (info.st_ino, info.st_size, info.st_mtime_ns)
+    modified = time.strftime(
+        '%a, %d %b %Y %H:%M:%S GMT', time.gmtime(info.st_mtime))
+
+    bottle.response.set_header('Accept-Ranges', 'bytes')
+    bottle.response.set_header('ETag', tag)
+    bottle.response.set_header('Last-Modified', modified)
+
+    header = bottle.request.get_header('Range')
+    condition = bottle.request.get_header('If-Range')
+
+    # A range of a file that changed since the client last saw it is no use
+    if condition != None and condition not in (tag, modified): header = None
+
+    partial = False
+
+    if header != None: ranges = parse_byte_ranges(header, size)
+    else: ranges = None
+
+    if ranges != None:
+        if len(ranges) == 0:
+            bottle.response.status = 416
+            bottle.response.set_header('Content-Range', 'bytes */%d' % size)
+            return ''
+
+        if len(ranges) <= file_range_count_max: partial = True
+
+    if not partial: ranges = [(0, size)]
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+
+        if partial:
+            bottle.response.status = 206
+            bottle.response.set_header(
+                'Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+
+        bottle.response.set_header('Content-Type', 'application/octet-stream')
+        bottle.response.set_header('Content-Length', str(end - start))
+        return FilePart(str(target), start, end - start)
+
+    boundary = hashlib.sha256(os.urandom(16)).hexdigest()[:32]
+    length = len(('\r\n--' + boundary + '--\r\n').encode())
+
+    for start, end in ranges:
+        length += len(multipart_header(start, end, size, boundary))
+        length += end - start
+
+    bottle.response.status = 206
+    bottle.response.set_header(
+        'Content-Type', 'multipart/byteranges; boundary=' + boundary)
+    bottle.response.set_header('Content-Length', str(length))
+
+    return multipart_ranges(str(target), ranges, size, boundary)
+
+def tar_file(path, name):
+    try: info = os.stat(path)
+    except OSError: return
+
+    if not stat.S_ISREG(info.st_mode): return
+
+    try: data = FilePart(path, 0, info.st_size)
+    except OSError: return
+
+    member = tarfile.TarInfo(name)
+    member.size = info.st_size
+    member.mtime = int(info.st_mtime)
+    member.mode = stat.S_IMODE(info.st_mode)
+
+    try:
+        yield member.tobuf(tarfile.PAX_FORMAT)
+        left = info.st_size
+
+        for block in data:
+            left -= len(block)
+            yield block
+
+        # The size is already in the header, make up for a file that shrank
+        while left > 0:
+            padding = min(left, file_stream_block_size)
+            left -= padding
+            yield tarfile.NUL * padding
+
+    finally: data.close()
+
+    yield tarfile.NUL * (-info.st_size % tarfile.BLOCKSIZE)
+
+def tar_dir(path, name):
+    try: info = os.stat(path)
+    except OSError: return
+
+    member = tarfile.TarInfo(name)
+    member.type = tarfile.DIRTYPE
+    member.mtime = int(info.st_mtime)
+    member.mode = stat.S_IMODE(info.st_mode)
+
+    yield member.tobuf(tarfile.PAX_FORMAT)
+
+# A tar archive of a directory tree made while it is sent. Linked directories
+# are not followed so the walk always ends.
+def stream_tar(target, base):
+    sent = 0
+
+    for root, dirs, files in os.walk(target):
+        dirs[:] = [
+            dir for dir in sorted(dirs)
+            if not os.path.islink(os.path.join(root, dir))
+        ]
+
+        relative = os.path.relpath(root, target)
+
+        if relative == '.': name = base
+        else: name = base + '/' + relative.replace(os.sep, '/')
+
+        for block in tar_dir(root, name):
+            sent += len(block)
+            yield block
+
+        for file in sorted(files):
+            path = os.path.join(root, file)
+
+            for block in tar_file(path, name + '/' + file):
+                sent += len(block)
+                yield block
+
+    end = tarfile.BLOCKSIZE * 2
+    end += -(sent + end) % tarfile.RECORDSIZE
+    yield tarfile.NUL * end
+
+@app.get('/archive/<sharename>')
+@app.get('/archive/<sharename>/<path:path>')
+def read_dir_archive(sharename, path=''):
+    if sharename not in shares:
+        return {'status': 'error', 'reason': 'not exist'}
+
+    share = pathlib.Path(shares[sharename]).resolve()
+    target = share / path
+
+    if not target.exists():
+        return {'status': 'error', 'reason': 'not exist'}
+
+    if not target.is_dir():
+        return {'status': 'error', 'reason': 'not dir'}
+
+    if target == share: base = sharename
+    else: base = target.name
+
+    bottle.response.set_header('Content-Type', 'application/x-tar')
+    bottle.response.set_header(
+        'Content-Disposition', 'attachment; filename="' + base + '.tar"')
+
+    return stream_tar(str(target), base)
+
 class Server:
     def __init__(self, cherrypy, api):
         self.__cherrypy = cherrypy
@@ -181,6 +1028,7 @@ class Server:
         if self.is_started():
             self.__cherrypy.engine.exit()
             self.__set_started(False)
+            manifests.close()
 
 server_instance = None
 
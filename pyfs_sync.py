@@ -0,0 +1,312 @@
+import os
+import sys
+import time
+import queue
+import pathlib
+import argparse
+import datetime
+
+import pyfs_client
+
+# Kept in the destination directory: progress of the files being
+# downloaded, so a sync that is stopped carries on where it left off the next
+# time, and a lock so syncs of the same directory do not overlap.
+journal_name = '.pyfs-sync.journal'
+lock_name = '.pyfs-sync.lock'
+
+# How many files are downloaded at the same time. Files beyond these wait
+# their turn so open files stay few however many have changed.
+sync_files_in_flight = 32
+
+# The server sends modification times to the second
+mtime_tolerance = 1
+
+# Seconds the downloads may go without any of them moving before the sync
+# gives up on them. They carry on from where they were on the next sync.
+sync_stall_timeout = 300
+
+def remote_mtime(moment):
+    try: moment = datetime.datetime.strptime(moment, '%j%Y%H%M%S%z')
+    except (TypeError, ValueError): return None
+
+    return moment.timestamp()
+
+# Files with the same size and modification time as on the server are taken
+# to be the same and are not compared further.
+def unchanged(dest, size, mtime):
+    try: info = os.stat(dest)
+    except OSError: return False
+
+    if mtime == None: return False
+
+    same_size = info.st_size == size
+    return same_size and abs(info.st_mtime - mtime) < mtime_tolerance
+
+def lock_dest(root):
+    try: import fcntl
+    except ImportError: return True # Windows
+
+    try:
+        lock = open(root / lock_name, 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    except OSError: return None
+
+    return lock
+
+# Download events are taken from events, a queue the client was made to put
+# them in
+class Mirror:
+    def __init__(
+        self, client, events, source, dest, include=(), exclude=(),
+        verbose=False, dry_run=False, timeout=sync_stall_timeout
+    ):
+        self.__client = client
+        self.__source = source.strip('/')
+        self.__dest = dest
+        self.__include = include
+        self.__exclude = exclude
+        self.__verbose = verbose
+        self.__dry_run = dry_run
+        self.__timeout = timeout
+
+        self.__events = events
+        self.__pending = {} # Files being downloaded as path: (dest, mtime)
+        self.__listed = set()
+        self.__counts = {'checked': 0, 'fetched': 0, 'failed': 0}
+        self.__moved = time.monotonic()
+        self.__bytesdone = {} # Progress last seen as path: bytes done
+
+    def __log(self, *args):
+        if self.__verbose: print(*args)
+
+    def __error(self, *args): print(*args, file=sys.stderr)
+
+    # Returns 0 if everything is in sync, 1 if some files failed and 2 if the
+    # source could not be listed.
+    def run(self):
+        tree = self.__client.list_tree(
+            self.__source, include=self.__include, exclude=self.__exclude
+        )
+
+        header = next(tree, None)
+
+        if header == None or header['status'] != 'ok':
+            self.__error('Cannot list', self.__source)
+            return 2
+
+        if header['type'] != 'dir':
+            self.__error('Not a directory:', self.__source)
+            return 2
+
+        base = header['info']['path']
+
+        complete = True
+
+        # Files are started while the tree is still arriving
+        for entry in tree:
+            if entry.get('status') == 'error':
+                self.__error('Listing of', self.__source, 'was cut short')
+                self.__counts['failed'] += 1
+                complete = False
+                break
+
+            dest = pyfs_client.local_path(self.__dest, entry['path'])
+
+            if dest == None:
+                self.__error('Skipping', entry['path'])
+                continue
+
+            if entry['type'] == 'dir':
+                if not self.__dry_run: dest.mkdir(parents=True, exist_ok=True)
+                continue
+
+            self.__counts['checked'] += 1
+            path = base + entry['path']
+            self.__listed.add(path)
+
+            mtime = remote_mtime(entry.get('modified'))
+            if unchanged(dest, entry.get('size'), mtime): continue
+
+            if self.__dry_run:
+                print(path)
+                continue
+
+            while len(self.__pending) >= sync_files_in_flight:
+                if not self.__handle_next(): return self.__stalled()
+
+            self.__log('Downloading', path)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+
+            self.__pending[path] = (dest, mtime)
+
+            # The listing is passed on so the file is not listed again
+            info = None
+
+            if 'size' in entry:
+                info = {
+                    'name': pathlib.PurePosixPath(path).name, 'path': path,
+                    'size': entry['size'], 'modified': entry.get('modified')
+                }
+
+            self.__client.getfile(
+                path, saveto=str(dest), update=True, info=info
+            )
+
+            self.__handle_ready()
+
+        # Files left over that are no longer on the server are dropped. Not
+        # all of them are known to be gone if the listing was cut short.
+        for path in list(self.__pending):
+            if complete and path not in self.__listed:
+                self.__client.getfile_cancel(path)
+                del self.__pending[path]
+
+        while len(self.__pending) > 0:
+            if not self.__handle_next(): return self.__stalled()
+
+        self.__log(
+            'Checked', self.__counts['checked'], 'files, downloaded',
+            self.__counts['fetched'], 'and failed', self.__counts['failed']
+        )
+
+        if self.__counts['failed'] > 0: return 1
+        else: return 0
+
+    # Handles the next event, waiting while any download is moving. Returns
+    # False if none has for the timeout.
+    def __handle_next(self):
+        while True:
+            try:
+                event = self.__events.get(timeout=1)
+                break
+
+            except queue.Empty: pass
+
+            for path in self.__pending:
+                progress = self.__client.getfile_progress(path)
+                if progress == None: continue
+
+                if self.__bytesdone.get(path) != progress['bytesdone']:
+                    self.__bytesdone[path] = progress['bytesdone']
+                    self.__moved = time.monotonic()
+
+            if time.monotonic() - self.__moved > self.__timeout: return False
+
+        self.__moved = time.monotonic()
+        self.__handle(event)
+        return True
+
+    # Downloads that stopped moving are paused and stay in the journal
+    def __stalled(self):
+        for path in self.__pending:
+            self.__client.getfile_pause(path)
+            self.__counts['failed'] += 1
+            self.__error('Timed out downloading', path)
+
+        self.__pending = {}
+        return 1
+
+    def __handle_ready(self):
+        while True:
+            try: event = self.__events.get_nowait()
+            except queue.Empty: return
+
+            self.__handle(event)
+
+    def __handle(self, event):
+        if 'status' not in event or 'path' not in event: return
+
+        status = event['status']
+        path = event['path']
+
+        # Left over from a sync that was stopped
+        if status == 'fileverifying' and path not in self.__pending:
+            self.__pending[path] = (None, None)
+            return
+
+        if path not in self.__pending: return
+
+        if status == 'filedone':
+            dest, mtime = self.__pending.pop(path)
+            self.__bytesdone.pop(path, None)
+            self.__counts['fetched'] += 1
+
+            # Matched against the server's on the next sync
+            if mtime != None:
+                try: os.utime(dest, (mtime, mtime))
+                except OSError: pass
+
+        elif status == 'fileerror' or status == 'filecanceled':
+            self.__pending.pop(path)
+            self.__bytesdone.pop(path, None)
+            self.__counts['failed'] += 1
+            self.__error('Failed to download', path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Mirror a directory of a pyfs share to a local directory.'
+    )
+
+    parser.add_argument('server', help='address like http://host:8080')
+    parser.add_argument('source', help='share and path like share/dir')
+    parser.add_argument('dest', help='local directory to mirror to')
+
+    parser.add_argument(
+        '--include', action='append', default=[], metavar='GLOB',
+        help='only files matching GLOB, may be given more than once'
+    )
+
+    parser.add_argument(
+        '--exclude', action='append', default=[], metavar='GLOB',
+        help='skip files and directories matching GLOB'
+    )
+
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help='list the files that would be downloaded'
+    )
+
+    parser.add_argument(
+        '--timeout', type=float, default=sync_stall_timeout, metavar='SECONDS',
+        help='give up once downloads have not moved for this long'
+    )
+
+    parser.add_argument('-v', '--verbose', action='store_true')
+
+    args = parser.parse_args()
+
+    dest = pathlib.Path(args.dest).resolve()
+    dest.mkdir(parents=True, exist_ok=True)
+
+    lock = lock_dest(dest)
+
+    if lock == None:
+        print('Another sync is using', dest, file=sys.stderr)
+        sys.exit(3)
+
+    events = queue.Queue()
+
+    # Only listing is needed to tell what would be downloaded. Downloads left
+    # in the journal report in as soon as the client starts.
+    if args.dry_run: client = pyfs_client.ClientLogic(args.server)
+
+    else:
+        journal = str(dest / journal_name)
+        client = pyfs_client.PyFSClient(args.server, journal, events.put)
+
+    if not client.server_ok():
+        print('Cannot connect to', args.server, file=sys.stderr)
+        sys.exit(2)
+
+    mirror = Mirror(
+        client, events, args.source, dest, args.include, args.exclude,
+        args.verbose, args.dry_run, args.timeout
+    )
+
+    try: code = mirror.run()
+
+    finally:
+        if not args.dry_run: client.cleanup()
+
+    sys.exit(code)
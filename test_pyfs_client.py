@@ -0,0 +1,145 @@
+import json
+import random
+
+import pyfs_client
+from pyfs_client import ranges_add, ranges_size, aligned_part_size
+from pyfs_client import ProgressJournal
+
+def test_ranges_add_joins_neighbours():
+    ranges = [(0, 10), (20, 30)]
+    ranges_add(ranges, 10, 20)
+    assert ranges == [(0, 30)]
+
+def test_ranges_add_keeps_apart():
+    ranges = [(0, 10), (40, 50)]
+    ranges_add(ranges, 20, 30)
+    assert ranges == [(0, 10), (20, 30), (40, 50)]
+
+def test_ranges_add_spans_several():
+    ranges = [(0, 10), (20, 30), (40, 50)]
+    ranges_add(ranges, 5, 45)
+    assert ranges == [(0, 50)]
+    assert ranges_size(ranges) == 50
+
+def test_ranges_add_inside():
+    ranges = [(0, 100)]
+    ranges_add(ranges, 10, 20)
+    assert ranges == [(0, 100)]
+
+def test_ranges_add_random():
+    rng = random.Random(1)
+
+    for unused in range(200):
+        ranges = []
+        done = set()
+
+        for unused in range(20):
+            start = rng.randrange(0, 200)
+            end = start + rng.randrange(1, 40)
+            ranges_add(ranges, start, end)
+            done.update(range(start, end))
+
+        assert ranges_size(ranges) == len(done)
+
+        for (first, last), (after, unused) in zip(ranges, ranges[1:]):
+            assert first < last < after
+
+def test_aligned_part_size():
+    assert aligned_part_size(0, 8, 100, 1, 16) == 8
+    assert aligned_part_size(4, 8, 100, 1, 16) == 4
+    assert aligned_part_size(8, 8, 3, 1, 16) == 2
+    assert aligned_part_size(3, 8, 100, 2, 16) == None
+
+def journal_task(path, saveto):
+    return {
+        'listing': {'info': {'name': path, 'path': 't/' + path}},
+        'size': 100, 'ranges': [], 'chunksize': 10, 'saveto': str(saveto),
+        'paused': False, 'file': open(saveto, 'w+b')
+    }
+
+def journal_lines(path):
+    return [json.loads(line) for line in open(path).read().splitlines()]
+
+def test_journal_replay_ops(tmp_path):
+    path = tmp_path / 'progress.journal'
+    first = {
+        'op': 'task', 'path': 't/a', 'listing': {'info': {'path': 't/a'}},
+        'size': 100, 'ranges': [[0, 10]], 'chunksize': 10, 'saveto': 'a',
+        'paused': False
+    }
+
+    records = [
+        first, {'op': 'range', 'path': 't/a', 'start': 10, 'end': 30},
+        {'op': 'set', 'path': 't/a', 'fields': {'paused': True}},
+        dict(first, path='t/b'), {'op': 'remove', 'path': 't/b'},
+        {'op': 'range', 'path': 't/c', 'start': 0, 'end': 10}
+    ]
+
+    path.write_text(''.join([json.dumps(record) + '\n' for record in records]))
+
+    tasks = ProgressJournal(path).load()
+    assert len(tasks) == 1
+    assert tasks[0]['ranges'] == [(0, 30)]
+    assert tasks[0]['paused'] == True
+
+    # Loading leaves one record per task behind
+    assert [record['op'] for record in journal_lines(path)] == ['task']
+
+def test_journal_truncated_line(tmp_path):
+    path = tmp_path / 'progress.journal'
+    task = journal_task('a', tmp_path / 'a')
+
+    journal = ProgressJournal(path)
+    journal.add(task)
+    journal.written(task, 0, 10)
+    journal.sync(None, True)
+
+    # Cut short by a crash in the middle of a record
+    with open(path, 'a') as file: file.write('{"op": "range", "path": "t/')
+
+    tasks = ProgressJournal(path).load()
+    assert len(tasks) == 1
+    assert tasks[0]['ranges'] == [(0, 10)]
+
+def test_journal_finished_and_canceled(tmp_path):
+    path = tmp_path / 'progress.journal'
+    tasks = [journal_task(name, tmp_path / name) for name in ('a', 'b', 'c')]
+
+    journal = ProgressJournal(path)
+    for task in tasks: journal.add(task)
+    journal.written(tasks[0], 0, 100)
+    journal.finished(tasks[0])
+    journal.canceled(tasks[1])
+    journal.sync(None)
+    assert not path.exists() # Kept back until the interval is up
+
+    journal.sync(None, True)
+
+    loaded = ProgressJournal(path).load()
+    assert [task['listing']['info']['path'] for task in loaded] == ['t/c']
+
+def test_journal_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(pyfs_client, 'progress_compact_records', 5)
+
+    path = tmp_path / 'progress.journal'
+    task = journal_task('a', tmp_path / 'a')
+
+    journal = ProgressJournal(path)
+    journal.add(task)
+
+    for start in range(0, 100, 10):
+        journal.written(task, start, start + 10)
+        ranges_add(task['ranges'], start, start + 10)
+
+    journal.sync([task], True)
+    assert len(journal_lines(path)) == 11
+
+    journal.update(task, paused=True)
+    task['paused'] = True
+    journal.sync([task], True)
+
+    assert journal_lines(path) == [{
+        'op': 'task', 'path': 't/a', 'listing': task['listing'], 'size': 100,
+        'ranges': [[0, 100]], 'chunksize': 10, 'priority': 0,
+        'saveto': task['saveto'], 'paused': True, 'created': True
+    }]
@@ -0,0 +1,57 @@
+import os
+import shelve
+
+from pyfs_server import parse_byte_ranges, HashManifests, hash_file_part
+
+def test_parse_byte_ranges():
+    assert parse_byte_ranges('bytes=0-9', 100) == [(0, 10)]
+    assert parse_byte_ranges('bytes=-5', 100) == [(95, 100)]
+    assert parse_byte_ranges('bytes=90-', 100) == [(90, 100)]
+    assert parse_byte_ranges('bytes=90-200', 100) == [(90, 100)]
+    assert parse_byte_ranges('bytes=0-1, 4-5', 100) == [(0, 2), (4, 6)]
+
+def test_parse_byte_ranges_ignored():
+    assert parse_byte_ranges('bytes=abc', 100) == None
+    assert parse_byte_ranges('bytes=5-2', 100) == None
+    assert parse_byte_ranges('bytes=', 100) == None
+    assert parse_byte_ranges('items=0-1', 100) == None
+
+def test_parse_byte_ranges_outside():
+    assert parse_byte_ranges('bytes=100-', 100) == []
+    assert parse_byte_ranges('bytes=-0', 100) == []
+
+def test_hash_manifests(tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'a' * 10 + b'b' * 5)
+
+    manifests = HashManifests(str(tmp_path / 'hashes.shelf'))
+    hashes = manifests.digests(str(path), os.stat(path), 10)
+    assert hashes[0] == hash_file_part(str(path), 0, 10)
+    assert hashes[1] == hash_file_part(str(path), 10, 5)
+
+    manifests.close()
+
+    # Stored digests are used again as long as the file is unchanged
+    manifests = HashManifests(str(tmp_path / 'hashes.shelf'))
+    assert manifests.digest(str(path), os.stat(path), 10, 1) == hashes[1]
+    manifests.close()
+
+def test_hash_manifests_pruned(tmp_path):
+    kept, gone = tmp_path / 'kept', tmp_path / 'gone'
+    kept.write_bytes(b'kept')
+    gone.write_bytes(b'gone')
+
+    manifests = HashManifests(str(tmp_path / 'hashes.shelf'))
+    manifests.digests(str(kept), os.stat(kept), 10)
+    manifests.digests(str(gone), os.stat(gone), 10)
+    manifests.close()
+
+    gone.unlink()
+
+    # Entries of files that are gone are dropped when the storage is opened
+    manifests = HashManifests(str(tmp_path / 'hashes.shelf'))
+    manifests.digests(str(kept), os.stat(kept), 10)
+    manifests.close()
+
+    with shelve.open(str(tmp_path / 'hashes.shelf')) as shelf:
+        assert sorted(shelf.keys()) == [str(kept) + '\n10']